@@ -0,0 +1,45 @@
+"""
+Throughput of AsyncApi against the threaded synchronous Api, on the local mock server.
+
+Both clients send the same number of get_if_user_saved requests to a server that answers after a fixed latency;
+the threaded client is limited by its thread count, the async one by its connection limit.
+
+    python benchmarks/bench_async.py [requests] [latency seconds]
+"""
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from mock_server import MockSpotify
+from spotify_api import AsyncApi
+
+def bench_threads(server:MockSpotify, requests:int, threads:int):
+    api = server.api(max_workers=threads)
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        statuses = list(executor.map(lambda i: api.get_if_user_saved("tracks", [str(i)]).status_code, range(requests)))
+    elapsed = perf_counter() - start
+    assert statuses == [200] * requests
+    return requests / elapsed
+
+async def bench_async(server:MockSpotify, requests:int, connections:int):
+    async with server.api(AsyncApi, max_connections=connections) as api:
+        start = perf_counter()
+        responses = await asyncio.gather(*(api.get_if_user_saved("tracks", [str(i)]) for i in range(requests)))
+        elapsed = perf_counter() - start
+    assert [response.status_code for response in responses] == [200] * requests
+    return requests / elapsed
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    with MockSpotify(latency=latency) as server:
+        print(f"{requests} requests, {latency * 1000:.0f} ms server latency")
+        for threads in (8, 32):
+            print(f"  Api + {threads:>3} threads:       {bench_threads(server, requests, threads):>8.0f} req/s")
+        for connections in (100, 500):
+            print(f"  AsyncApi, {connections:>3} connections: {asyncio.run(bench_async(server, requests, connections)):>8.0f} req/s")
+
+if __name__ == "__main__":
+    main()
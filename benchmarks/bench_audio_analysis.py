@@ -0,0 +1,59 @@
+"""
+Memory and parse time of the dict and the columnar (AudioAnalysis) forms of get_audio_analysis.
+
+Builds a synthetic analysis the size of a long track, then compares json.loads with AudioAnalysis.from_json,
+and reloading the columnar form from .npz, read and memory-mapped. For each it reports the parse time (best of several runs, without tracemalloc),
+the memory still held by the result and the peak memory while parsing, and how each compares with the dict form.
+
+    python benchmarks/bench_audio_analysis.py [segments]
+"""
+import json
+import sys
+import tracemalloc
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from spotify_api import AudioAnalysis
+from mock_server import audio_analysis
+
+def analysis_json(segments:int, seed:int=0):
+    return json.dumps(audio_analysis(segments, seed))
+
+def measure(func, runs:int=5):
+    """
+    Best time of runs calls, then the retained and peak memory of one more call under tracemalloc (which slows it down).
+    """
+    elapsed = float("inf")
+    for _ in range(runs):
+        start = perf_counter()
+        result = func()
+        elapsed = min(elapsed, perf_counter() - start)
+        del result
+    tracemalloc.start()
+    result = func()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, retained, peak
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    body = analysis_json(segments)
+    print(f"{segments} segments, {len(body) / 2 ** 20:.1f} MB of json")
+    print(f"{'form':<22} {'time (ms)':>10} {'retained (MB)':>14} {'peak (MB)':>10} {'time':>7} {'retained':>9} {'peak':>7}")
+    rows = [("dict (json.loads)", lambda: json.loads(body)), ("AudioAnalysis", lambda: AudioAnalysis.from_json(body))]
+    with TemporaryDirectory() as directory:
+        file = path.join(directory, "analysis.npz")
+        AudioAnalysis.from_json(body).save(file)
+        rows += [("npz load", lambda: AudioAnalysis.load(file)), ("npz load, mmap", lambda: AudioAnalysis.load(file, mmap=True))]
+        baseline = None
+        for name, func in rows:
+            elapsed, retained, peak = measure(func)
+            baseline = baseline or (elapsed, retained, peak)
+            print(f"{name:<22} {elapsed * 1000:>10.1f} {retained / 2 ** 20:>14.2f} {peak / 2 ** 20:>10.2f} "
+                  f"{elapsed / baseline[0]:>6.2f}x {retained / baseline[1]:>8.2f}x {peak / baseline[2]:>6.2f}x") #relative to the dict form
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Time and memory of large playlist pages as dicts (decoded json) and as models (Api.parse), with the standard json module and, if installed, orjson.
+
+Builds the pages from the mock server's full track objects (markets, images, nested album and artists) without serving them,
+then reads the track id, name and album name of every item twice, the way most callers walk a page.
+The models hold less and decode faster, but their first read builds the nested models and is several times slower than reading the dicts;
+the x columns compare each form with the dicts of the same decoder.
+
+    python benchmarks/bench_models.py [pages]
+"""
+import gc
+import json
+import sys
+import tracemalloc
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from spotify_api import Api, Page, SavedTrack, lean_loads
+from mock_server import MockSpotify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class Body(object):
+    """
+    Stand-in for a response, enough for Api.parse.
+    """
+    status_code = 200
+    url = "mock"
+
+    def __init__(self, content:bytes):
+        self.content = content
+
+def read_dicts(pages:list):
+    return [(item["track"]["id"], item["track"]["name"], item["track"]["album"]["name"]) for page in pages for item in page["items"]]
+
+def read_models(pages:list):
+    return [(item.track.id, item.track.name, item.track.album.name) for page in pages for item in page]
+
+def timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    server = MockSpotify(total=pages * 100, full_objects=True)
+    bodies = [json.dumps(server.offset_page("playlists/p/tracks", ["playlists", "p", "tracks"], {"offset":str(offset), "limit":"100"})).encode() for offset in range(0, pages * 100, 100)]
+    del server
+    api = Api.__new__(Api) #parse only needs a decoder, no credentials
+    forms = {"dict, json":(json.loads, None, "dict, json"), "models, lean_loads":(lean_loads, SavedTrack, "dict, json")} #form: decoder, model, dicts it is compared with
+    if orjson is not None:
+        forms.update({"dict, orjson":(orjson.loads, None, "dict, orjson"), "models, orjson":(orjson.loads, SavedTrack, "dict, orjson")})
+    print(f"{pages} pages of 100 playlist items, {sum(map(len, bodies)) / 2 ** 20:.1f} MB of json")
+    print(f"{'form':<20}{'decode (ms)':>12}{'1st read (ms)':>14}{'2nd read (ms)':>14}{'held (MB)':>10}{'held after read (MB)':>21}{'peak (MB)':>10}{'decode':>8}{'1st read':>9}{'held':>7}")
+    baselines = dict()
+    for form, (decoder, model, baseline) in forms.items():
+        api.decoder = decoder
+        if model is None:
+            decode, read = lambda: [decoder(body) for body in bodies], read_dicts
+        else:
+            decode, read = lambda: [api.parse(Body(body), lambda data: Page(data, model)) for body in bodies], read_models
+        gc.collect()
+        decoded, decode_time = timed(decode)
+        rows, first_time = timed(read, decoded)
+        _, second_time = timed(read, decoded)
+        assert len(rows) == pages * 100
+        del decoded, rows
+        gc.collect()
+        tracemalloc.start()
+        decoded = decode()
+        held = tracemalloc.get_traced_memory()[0]
+        read(decoded)
+        held_after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del decoded
+        decode_base, first_base, held_base = baselines.setdefault(baseline, (decode_time, first_time, held))
+        print(f"{form:<20}{decode_time * 1000:>12.1f}{first_time * 1000:>14.1f}{second_time * 1000:>14.1f}{held / 2 ** 20:>10.1f}{held_after / 2 ** 20:>21.1f}{peak / 2 ** 20:>10.1f}"
+            f"{decode_time / decode_base:>7.2f}x{first_time / first_base:>8.1f}x{held / held_base:>6.2f}x")
+    print("the first read of the models is slower than the dicts: every item builds its track and album models on first access")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Per request overhead of Auth.get_token.
+
+Every Api call goes through Auth.get_token, so its cost should not depend on how many calls were made before.
+Runs get_token against a valid token for growing amounts of calls and prints the time per call next to the
+old behaviour of dumping the tokens file on every call.
+
+    python benchmarks/bench_tokens.py
+"""
+import json
+import sys
+from os import path, stat
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from spotify_api import Auth
+
+SCOPE = "user-library-read user-read-playback-state"
+CALLS = (1000, 10000, 100000)
+
+def make_auth(directory:str):
+    credentials = path.join(directory, "credentials.json")
+    tokens = path.join(directory, "tokens.json")
+    with open(credentials, "w") as f:
+        json.dump({"user":"user", "client_id":"id", "client_secret":"secret", "redirect_uri":"http://localhost:8888/callback"}, f)
+    with open(tokens, "w") as f:
+        json.dump({"access_token":"a"*200, "token_type":"Bearer", "scope":SCOPE, "expires_in":3600, "expires_at":time() + 3600, "refresh_token":"r"*130}, f)
+    return Auth(credentials, tokens)
+
+def bench(auth:Auth, calls:int, dump:bool):
+    start = perf_counter()
+    for _ in range(calls):
+        token = auth.get_token("user-library-read")
+        if dump:
+            json.dump(token, open(auth.tokens_loc, "w"))
+    return (perf_counter() - start) / calls * 1e6
+
+def main():
+    with TemporaryDirectory() as directory:
+        auth = make_auth(directory)
+        print(f"{'calls':>8} {'in memory (us/call)':>20} {'dump per call (us/call)':>24}")
+        for calls in CALLS:
+            mtime = stat(auth.tokens_loc).st_mtime_ns
+            memory = bench(auth, calls, False)
+            unchanged = stat(auth.tokens_loc).st_mtime_ns == mtime
+            dumped = bench(auth, min(calls, 10000), True)
+            print(f"{calls:>8} {memory:>20.3f} {dumped:>24.3f}")
+            if not unchanged:
+                raise Exception("tokens file was written while the token was valid")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+Local stand-in for accounts.spotify.com/api/token and api.spotify.com/v1, used by the benchmarks.
+
+    with MockSpotify(latency=0.02) as server:
+        api = server.api()
+        api.get_artists(["a", "b"])
+
+It can also run on its own, for clients in other processes:
+
+    python benchmarks/mock_server.py --port 8080 --latency 0.02 --full-objects
+"""
+import json
+from argparse import ArgumentParser
+from hashlib import sha1
+from random import Random
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+import spotify_api
+
+MARKETS = ["AD", "AE", "AG", "AL", "AM", "AO", "AR", "AT", "AU", "AZ", "BA", "BB", "BD", "BE", "BF", "BG", "BH", "BI", "BJ", "BN", "BO", "BR", "BS", "BT", "BW", "BY", "BZ", "CA", "CD", "CG", "CH", "CI", "CL", "CM", "CO", "CR", "CV", "CW", "CY", "CZ", "DE", "DJ", "DK", "DM", "DO", "DZ", "EC", "EE", "EG", "ES", "ET", "FI", "FJ", "FM", "FR", "GA", "GB", "GD", "GE", "GH", "GM", "GN", "GQ", "GR", "GT", "GW", "GY", "HK", "HN", "HR", "HT", "HU", "ID", "IE", "IL", "IN", "IQ", "IS", "IT", "JM", "JO", "JP", "KE", "KG", "KH", "KI", "KM", "KN", "KR", "KW", "KZ", "LA", "LB", "LC", "LI", "LK", "LR", "LS", "LT", "LU", "LV", "LY", "MA", "MC", "MD", "ME", "MG", "MH", "MK", "ML", "MN", "MO", "MR", "MT", "MU", "MV", "MW", "MX", "MY", "MZ", "NA", "NE", "NG", "NI", "NL", "NO", "NP", "NR", "NZ", "OM", "PA", "PE", "PG", "PH", "PK", "PL", "PS", "PT", "PW", "PY", "QA", "RO", "RS", "RW", "SA", "SB", "SC", "SE", "SG", "SI", "SK", "SL", "SM", "SN", "SR", "ST", "SV", "SZ", "TD", "TG", "TH", "TJ", "TL", "TN", "TO", "TR", "TT", "TV", "TW", "TZ", "UA", "UG", "US", "UY", "UZ", "VC", "VE", "VN", "VU", "WS", "XK", "ZA", "ZM", "ZW"]
+SCOPE = " ".join(("user-library-read", "user-library-modify", "user-follow-read", "user-follow-modify", "user-top-read", "user-read-playback-state", "user-modify-playback-state", "user-read-recently-played", "playlist-read-private", "playlist-read-collaborative", "playlist-modify-private", "playlist-modify-public"))
+
+def audio_analysis(segments:int, seed=0):
+    """
+    Synthetic audio analysis with the given number of segments (of 0.25 seconds) and the matching bars, beats, tatums and sections.
+    """
+    random = Random(seed)
+    def intervals(count, length):
+        return [{"start":i * length, "duration":length, "confidence":random.random()} for i in range(count)]
+    duration = segments * 0.25
+    return {"meta":{"analyzer_version":"4.0.0", "status_code":0},
+            "track":{"duration":duration, "tempo":120.0, "key":5, "mode":1, "codestring":"x" * 4000, "echoprintstring":"y" * 20000},
+            "bars":intervals(int(duration / 2), 2.0), "beats":intervals(int(duration * 2), 0.5), "tatums":intervals(int(duration * 4), 0.25),
+            "sections":[dict(interval, loudness=-8.0, tempo=120.0, tempo_confidence=0.5, key=5, key_confidence=0.4, mode=1, mode_confidence=0.6, time_signature=4, time_signature_confidence=1.0) for interval in intervals(12, duration / 12)],
+            "segments":[{"start":i * 0.25, "duration":0.25, "confidence":random.random(), "loudness_start":-20 * random.random(), "loudness_max_time":0.1,
+                         "loudness_max":-10 * random.random(), "loudness_end":0.0, "pitches":[random.random() for _ in range(12)], "timbre":[random.uniform(-100, 100) for _ in range(12)]}
+                        for i in range(segments)]}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status:int, body=None, headers:dict=None, payload:bytes=None):
+        if payload is None:
+            payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def handle_any(self, verb:str):
+        server = self.server.mock
+        parsed = urlparse(self.path)
+        query = dict(parse_qsl(parsed.query))
+        body = self.read_body()
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            sleep(server.latency)
+        if parsed.path == "/api/token":
+            with server.lock:
+                server.token_requests += 1
+            form = dict(parse_qsl(body.decode()))
+            status, response, headers = 200, server.token(form), None
+        elif parsed.path.startswith("/v1/") and server.throttle():
+            status, response, headers = 429, {"error":{"status":429, "message":"API rate limit exceeded"}}, {"Retry-After":str(server.retry_after)}
+        elif parsed.path.startswith("/v1/"):
+            status, response, headers = server.route(verb, parsed.path[4:], query, body)
+            if verb == "GET" and status == 200:
+                payload = json.dumps(response).encode()
+                etag = '"' + sha1(payload).hexdigest() + '"'
+                headers = dict(headers or {}, ETag=etag)
+                if self.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    return self.send_json(304, None, headers)
+                return self.send_json(status, None, headers, payload)
+        else:
+            status, response, headers = 404, {"error":{"status":404, "message":"Not found"}}, None
+        self.send_json(status, response, headers)
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PUT(self):
+        self.handle_any("PUT")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+class MockSpotify(object):
+    """
+    Threaded mock of the Spotify token and Web API endpoints.
+    
+    Parameters:
+    
+        - latency: Seconds every response is delayed by.
+        - token_lifetime: expires_in of the issued tokens.
+        - total: Number of items behind every paged endpoint.
+        - throttle_every: Answer every n-th api request with a 429, 0 to never throttle.
+        - retry_after: Retry-After of the 429 responses, in seconds.
+        - full_objects: Serve full catalog objects (markets, images, nested album and artists) like the real API, instead of bare id/name ones.
+        - segments: Number of segments of the audio analyses.
+        - port: Port to listen on, 0 for any free one.
+    """
+    def __init__(self, latency:float=0.0, token_lifetime:int=3600, total:int=1000, throttle_every:int=0, retry_after:int=1, full_objects:bool=False, segments:int=1000, port:int=0):
+        self.latency = latency
+        self.full_objects = full_objects
+        self.segments = segments
+        self.total = total
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.throttled = 0
+        self.api_requests = 0
+        self.not_modified = 0
+        self.lock = Lock()
+        self.entities = dict() #built catalog objects, by (type, id, nested)
+        self.playlists = dict()
+        self.token_lifetime = token_lifetime
+        self.requests = 0
+        self.token_requests = 0
+        self.httpd = Server(("127.0.0.1", port), Handler)
+        self.httpd.mock = self
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def throttle(self):
+        with self.lock:
+            self.api_requests += 1
+            if not self.throttle_every:
+                return False
+            throttle = self.api_requests % self.throttle_every == 0
+            self.throttled += throttle
+            return throttle
+
+    def token(self, form:dict):
+        token = {"access_token":f"token-{self.token_requests}", "token_type":"Bearer", "expires_in":self.token_lifetime}
+        if form.get("grant_type") != "client_credentials":
+            token["scope"] = form.get("scope") or SCOPE
+            token["refresh_token"] = "refresh"
+        return token
+
+    def route(self, verb:str, endpoint:str, query:dict, body:bytes):
+        """
+        Answer a /v1/ request, returns (status, json body, headers).
+        """
+        parts = endpoint.strip("/").split("/")
+        if parts[0] == "playlists" and len(parts) > 1 and parts[1] in self.playlists:
+            return self.playlist_route(verb, parts, query, body)
+        if verb == "GET" and endpoint in ("me/following", "me/player/recently-played"):
+            return 200, self.cursor_page(endpoint, query), None
+        if verb == "GET" and parts == ["search"]:
+            return self.search(query)
+        if verb == "GET" and self.is_paged(parts):
+            return 200, self.offset_page(endpoint, parts, query), None
+        if "ids" in query and verb == "GET" and not parts[-1] == "contains":
+            key = parts[-1].replace("-", "_")
+            kind = key.rstrip("s") if key != "audio_features" else "audio_features"
+            return 200, {key:[self.entity(kind, i) for i in query["ids"].split(",")]}, None
+        if "ids" in query and verb == "GET":
+            return 200, [Random(i).random() < 0.5 for i in query["ids"].split(",")], None
+        if verb != "GET":
+            return 200, {"snapshot_id":"snapshot"}, None
+        if parts[0] == "artists" and parts[-1] == "related-artists":
+            random = Random(parts[1])
+            return 200, {"artists":[self.entity("artist", f"artist{random.randrange(self.total)}") for _ in range(20)]}, None
+        if parts[0] == "audio-analysis":
+            return 200, audio_analysis(self.segments, parts[1]), None
+        if parts[0] == "audio-features":
+            return 200, self.entity("audio_features", parts[1]), None
+        if len(parts) == 2 and parts[0] in ("tracks", "albums", "artists", "episodes", "shows", "playlists"):
+            return 200, self.entity(parts[0].rstrip("s"), parts[1]), None
+        return 200, {"id":parts[-1], "type":parts[0].rstrip("s")}, None
+
+    def entity(self, kind:str, entity_id:str, nested:bool=False):
+        """
+        Catalog object of the given type, the same for the same ID every time.
+        """
+        key = (kind, entity_id, nested)
+        if key not in self.entities:
+            self.entities[key] = self.build_entity(kind, entity_id, nested)
+        return self.entities[key]
+
+    def build_entity(self, kind:str, entity_id:str, nested:bool):
+        random = Random(f"{kind}:{entity_id}")
+        if kind == "audio_features":
+            return {"id":entity_id, "type":"audio_features", "uri":f"spotify:track:{entity_id}", "danceability":random.random(), "energy":random.random(), "key":random.randrange(12),
+                    "loudness":-60 * random.random(), "mode":random.randrange(2), "speechiness":random.random(), "acousticness":random.random(), "instrumentalness":random.random(),
+                    "liveness":random.random(), "valence":random.random(), "tempo":random.uniform(60, 200), "duration_ms":random.randrange(60000, 600000), "time_signature":4}
+        base = {"id":entity_id, "type":kind, "name":f"{kind} {entity_id}", "uri":f"spotify:{kind}:{entity_id}"}
+        if not self.full_objects:
+            return base
+        base.update(href=f"https://api.spotify.com/v1/{kind}s/{entity_id}", external_urls={"spotify":f"https://open.spotify.com/{kind}/{entity_id}"})
+        images = [{"url":f"https://i.scdn.co/image/{sha1(f'{entity_id}{size}'.encode()).hexdigest()}", "height":size, "width":size} for size in (640, 300, 64)]
+        if kind == "track":
+            base.update(duration_ms=random.randrange(60000, 600000), explicit=random.random() < 0.1, popularity=random.randrange(100), track_number=random.randrange(1, 15), disc_number=1,
+                        is_local=False, preview_url=f"https://p.scdn.co/mp3-preview/{entity_id}", external_ids={"isrc":f"US{random.randrange(10 ** 10):010d}"}, available_markets=MARKETS)
+            if not nested:
+                base.update(album=self.entity("album", f"al{random.randrange(10 ** 6)}", True), artists=[self.entity("artist", f"ar{random.randrange(10 ** 6)}", True) for _ in range(random.randrange(1, 3))])
+        elif kind == "album":
+            base.update(album_type="album", total_tracks=10, release_date="2020-01-01", release_date_precision="day", images=images, available_markets=MARKETS,
+                        artists=[self.entity("artist", f"ar{random.randrange(10 ** 6)}", True)])
+            if not nested:
+                base.update(genres=[], label="label", popularity=random.randrange(100), tracks={"items":[self.entity("track", f"{entity_id}t{n}", True) for n in range(10)], "total":10, "limit":50, "offset":0, "next":None})
+        elif kind == "artist" and not nested:
+            base.update(genres=["rock", "indie"], popularity=random.randrange(100), followers={"href":None, "total":random.randrange(10 ** 6)}, images=images)
+        else:
+            base.update(images=images, description=f"{kind} {entity_id} " * 8)
+        return base
+
+    def add_playlist(self, playlist_id:str, uris:list):
+        """
+        Serve playlist_id from a list of track URIs that the playlist endpoints read and modify.
+        """
+        self.playlists[playlist_id] = {"snapshot":0, "uris":list(uris)}
+
+    def playlist_route(self, verb:str, parts:list, query:dict, body:bytes):
+        with self.lock:
+            playlist = self.playlists[parts[1]]
+            uris = playlist["uris"]
+            data = json.loads(body) if body else {}
+            if verb == "GET" and len(parts) == 2:
+                return 200, {"id":parts[1], "type":"playlist", "snapshot_id":str(playlist["snapshot"]), "tracks":{"total":len(uris)}}, None
+            if verb == "GET":
+                limit = int(query.get("limit", 100))
+                offset = int(query.get("offset", 0))
+                items = [{"track":{"uri":uri, "id":uri.split(":")[-1]}} for uri in uris[offset:offset + limit]]
+                return 200, {"items":items, "limit":limit, "offset":offset, "total":len(uris)}, None
+            if "snapshot_id" in data and data["snapshot_id"] != str(playlist["snapshot"]):
+                return 400, {"error":{"status":400, "message":"Invalid snapshot id"}}, None
+            if verb == "POST":
+                added = query["uris"].split(",") if "uris" in query else data["uris"]
+                position = int(query.get("position", data.get("position", len(uris))))
+                uris[position:position] = added
+            elif verb == "DELETE":
+                dropped = set()
+                for track in data["tracks"]:
+                    dropped.update(track["positions"] if "positions" in track else (i for i, uri in enumerate(uris) if uri == track["uri"]))
+                uris[:] = [uri for i, uri in enumerate(uris) if i not in dropped]
+            elif "uris" in data:
+                uris[:] = data["uris"]
+            else:
+                start, length, before = data["range_start"], data.get("range_length", 1), data["insert_before"]
+                block = uris[start:start + length]
+                del uris[start:start + length]
+                uris[before if before < start else before - length:before if before < start else before - length] = block
+            playlist["snapshot"] += 1
+            return 201 if verb == "POST" else 200, {"snapshot_id":str(playlist["snapshot"])}, None
+
+    @staticmethod
+    def is_paged(parts:list):
+        if parts[0] == "me":
+            return len(parts) == 2 and parts[1] in ("tracks", "albums", "shows", "episodes", "playlists") or parts[1] == "top"
+        if parts[0] == "browse":
+            return parts[-1] in ("categories", "playlists", "featured-playlists", "new-releases")
+        return len(parts) == 3 and parts[2] in ("tracks", "albums", "playlists")
+
+    def item(self, parts:list, index:int):
+        if parts[0] == "playlists" or parts[0] == "me" and parts[1] in ("tracks", "albums", "shows", "episodes"):
+            kind = parts[-1].rstrip("s")
+            return {"added_at":"2020-01-01T00:00:00Z", "added_by":{"id":"user", "type":"user"}, "is_local":False, kind:self.entity(kind, f"{kind}{index}")}
+        kind = parts[-1].rstrip("s") if parts[-1] != "categories" else "category"
+        return self.entity(kind, f"{kind}{index}")
+
+    def offset_page(self, endpoint:str, parts:list, query:dict):
+        limit = int(query.get("limit", 20))
+        offset = int(query.get("offset", 0))
+        items = [self.item(parts, index) for index in range(offset, min(offset + limit, self.total))]
+        page = {"href":endpoint, "items":items, "limit":limit, "offset":offset, "total":self.total, "previous":None,
+                "next":f"{endpoint}?offset={offset + limit}&limit={limit}" if offset + limit < self.total else None}
+        return {"categories":page} if parts[-1] == "categories" else page
+
+    def search(self, query:dict):
+        offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+        if offset + limit > 1000 or offset > 1000:
+            return 400, {"error":{"status":400, "message":"Bad search offset"}}, None
+        digest = sha1(query.get("q", "").encode()).hexdigest()[:8]
+        body = dict()
+        for kind in query.get("type", "track").split(","):
+            items = [self.entity(kind, f"{kind}-{digest}-{index}") for index in range(offset, min(offset + limit, self.total))]
+            body[f"{kind}s"] = {"href":"search", "items":items, "limit":limit, "offset":offset, "total":self.total, "next":None, "previous":None}
+        return 200, body, None
+
+    def cursor_page(self, endpoint:str, query:dict):
+        limit = int(query.get("limit", 20))
+        start = int(query.get("after", "artist-1")[6:]) + 1
+        items = [self.entity("artist", f"artist{index}") for index in range(start, min(start + limit, self.total))]
+        last = items[-1]["id"] if items else None
+        page = {"href":endpoint, "items":items, "limit":limit, "total":self.total, "cursors":{"after":last}, "next":f"{endpoint}?after={last}" if start + limit < self.total else None}
+        return {"artists":page}
+
+    def api(self, cls=None, **kwargs):
+        """
+        Build an Api (or cls) pointed at this server, with a valid user token for every scope.
+        """
+        directory = mkdtemp()
+        credentials = path.join(directory, "credentials.json")
+        tokens = path.join(directory, "tokens.json")
+        with open(credentials, "w") as f:
+            json.dump({"user":"user", "client_id":"id", "client_secret":"secret", "redirect_uri":"http://127.0.0.1:8888/callback"}, f)
+        with open(tokens, "w") as f:
+            json.dump({"access_token":"token", "token_type":"Bearer", "scope":SCOPE, "expires_in":self.token_lifetime, "expires_at":time() + self.token_lifetime, "refresh_token":"refresh"}, f)
+        api = (cls or spotify_api.Api)(credentials, tokens, **kwargs)
+        api.base_url = self.url + "/v1/"
+        api.auth.token_url = self.url + "/api/token"
+        return api
+
+def main():
+    parser = ArgumentParser(description="Serve the mock Spotify token and Web API endpoints.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every response is delayed by")
+    parser.add_argument("--total", type=int, default=1000, help="items behind every paged endpoint")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every n-th api request with a 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--full-objects", action="store_true", help="serve full catalog objects")
+    parser.add_argument("--segments", type=int, default=1000, help="segments of the audio analyses")
+    args = parser.parse_args()
+    with MockSpotify(args.latency, total=args.total, throttle_every=args.throttle_every, retry_after=args.retry_after, full_objects=args.full_objects, segments=args.segments, port=args.port) as server:
+        print(f"Serving on {server.url}: token endpoint {server.url}/api/token, api {server.url}/v1/")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Benchmark suite: runs every scenario against a local MockSpotify serving full catalog objects and reports throughput, latency and peak memory.
+
+    python benchmarks/run.py [--latency 0.02] [--only bulk,paging] [--save results.json] [--baseline previous.json] [--threshold 0.2]
+
+With --baseline, every metric that got worse than the baseline by more than the threshold is reported and the exit status is 1,
+so the suite can gate changes: save the results of the base commit, then run the change against them.
+"""
+import asyncio
+import json
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from mock_server import MockSpotify
+from spotify_api import AsyncApi, RecordingTransport, ReplayTransport, aiohttp
+
+#For each metric, whether higher values are better
+METRICS = {"requests_per_second":True, "p50_ms":False, "p99_ms":False, "peak_mb":False, "seconds":False}
+
+def percentile(values:list, fraction:float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+def timed(func):
+    """
+    Wrap func so that each call appends its duration to the wrapper's timings.
+    """
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wrapper.timings.append(perf_counter() - start)
+    wrapper.timings = list()
+    return wrapper
+
+def measure(server, run):
+    """
+    Run run() twice and summarize it: throughput and latency (from the per-call timings run() returns) from a plain run,
+    peak memory from a run under tracemalloc, which slows everything down. The peak includes the mock server thread's allocations.
+    server is the MockSpotify (or ReplayTransport) whose counter gives the requests made.
+    """
+    count = (lambda: server.api_requests) if isinstance(server, MockSpotify) else (lambda: server.replayed)
+    requests = count()
+    start = perf_counter()
+    timings = run()
+    seconds = perf_counter() - start
+    requests = count() - requests
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"requests":requests, "seconds":round(seconds, 4), "requests_per_second":round(requests / seconds, 1),
+            "p50_ms":round(percentile(timings, 0.5) * 1000, 3), "p99_ms":round(percentile(timings, 0.99) * 1000, 3), "peak_mb":round(peak / 2 ** 20, 2)}
+
+def single(latency:float, count:int=1000, threads:int=16):
+    """
+    One track per request, from a pool of threads.
+    """
+    with MockSpotify(latency, full_objects=True) as server:
+        api = server.api(max_workers=threads)
+        def run():
+            get = timed(api.get_tracks)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                assert all(response.status_code == 200 for response in executor.map(lambda i: get([f"t{i}"]), range(count)))
+            return get.timings
+        return measure(server, run)
+
+def single_async(latency:float, count:int=1000, connections:int=100):
+    """
+    One track per request, from concurrent coroutines.
+    """
+    async def run_async(api, timings):
+        async def get(i):
+            start = perf_counter()
+            response = await api.get_tracks([f"t{i}"])
+            timings.append(perf_counter() - start)
+            return response.status_code
+        async with api:
+            assert await asyncio.gather(*map(get, range(count))) == [200] * count
+    with MockSpotify(latency, full_objects=True) as server:
+        def run():
+            timings = list()
+            asyncio.run(run_async(server.api(AsyncApi, max_connections=connections), timings))
+            return timings
+        return measure(server, run)
+
+def bulk(latency:float, count:int=5000):
+    """
+    get_tracks_bulk of many IDs, 50 per request.
+    """
+    with MockSpotify(latency, full_objects=True) as server:
+        api = server.api()
+        def run():
+            tracks = api.get_tracks_bulk([f"t{i}" for i in range(count)])
+            assert len(tracks) == count
+            return list()
+        result = measure(server, run)
+        del result["p50_ms"], result["p99_ms"] #a single call
+        return result
+
+def paging(latency:float, total:int=10000):
+    """
+    Every item of a large playlist through iter_playlist_tracks.
+    """
+    with MockSpotify(latency, total=total, full_objects=True) as server:
+        api = server.api()
+        def run():
+            timings, last = list(), perf_counter()
+            count = 0
+            for _ in api.iter_playlist_tracks("playlist"):
+                count += 1
+                if count % 100 == 0:
+                    timings.append(perf_counter() - last)
+                    last = perf_counter()
+            assert count == total
+            return timings
+        return measure(server, run)
+
+def paging_replay(latency:float, total:int=10000):
+    """
+    The paging scenario replayed from a cassette at wire speed, no server or network: the client's own cost.
+    """
+    with TemporaryDirectory() as directory:
+        cassette = path.join(directory, "paging.jsonl.gz")
+        with MockSpotify(latency, total=total, full_objects=True) as server:
+            recorder = RecordingTransport(cassette)
+            api = server.api(transport=recorder)
+            assert sum(1 for _ in api.iter_playlist_tracks("playlist")) == total
+            recorder.close()
+        replay = ReplayTransport(cassette)
+        api.transport = replay
+        def run():
+            timings, last = list(), perf_counter()
+            for count, _ in enumerate(api.iter_playlist_tracks("playlist"), 1):
+                if count % 100 == 0:
+                    timings.append(perf_counter() - last)
+                    last = perf_counter()
+            return timings
+        return measure(replay, run)
+
+def analysis(latency:float, count:int=20, segments:int=2000, columnar:bool=False):
+    """
+    get_audio_analysis of long tracks, keeping every result.
+    """
+    with MockSpotify(latency, segments=segments) as server:
+        api = server.api()
+        def run():
+            get = timed(api.get_audio_analysis)
+            results = [get(f"t{i}", columnar=columnar) for i in range(count)]
+            assert len(results) == count
+            return get.timings
+        return measure(server, run)
+
+SCENARIOS = {"single":single, "single_async":single_async, "bulk":bulk, "paging":paging, "paging_replay":paging_replay,
+             "analysis_dict":analysis, "analysis_columnar":lambda latency: analysis(latency, columnar=True)}
+
+def compare(results:dict, baseline:dict, threshold:float):
+    """
+    Metrics of results that are worse than in baseline by more than threshold (a fraction), as lines of text.
+    """
+    regressions = list()
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(scenario, {}).get(metric)
+            if metric not in METRICS or not previous:
+                continue
+            change = (value - previous) / previous
+            if (-change if METRICS[metric] else change) > threshold:
+                regressions.append(f"{scenario}.{metric}: {previous} -> {value} ({change:+.0%})")
+    return regressions
+
+def main():
+    parser = ArgumentParser(description="Run the spotify_api benchmarks against a local mock server.")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every mock response is delayed by")
+    parser.add_argument("--only", help="comma separated scenarios to run, out of " + ", ".join(SCENARIOS))
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file of earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args()
+    names = args.only.split(",") if args.only else list(SCENARIOS)
+    if aiohttp is None and "single_async" in names:
+        print("aiohttp is not installed, skipping single_async")
+        names.remove("single_async")
+    results = dict()
+    print(f"{'scenario':<18} {'requests':>8} {'seconds':>8} {'req/s':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'peak (MB)':>9}")
+    for name in names:
+        result = results[name] = SCENARIOS[name](args.latency)
+        print(f"{name:<18} {result['requests']:>8} {result['seconds']:>8.2f} {result['requests_per_second']:>9.0f} "
+              f"{result.get('p50_ms', float('nan')):>9.2f} {result.get('p99_ms', float('nan')):>9.2f} {result['peak_mb']:>9.1f}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print("regression:", line)
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions over {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Many threads sharing one Auth against the mock token server, whose tokens expire every few seconds.
+
+Checks that every expiry window costs a single token request per slot (client and user) however many threads see
+the token expire at once, that the tokens file is never left half written, and compares the worst get_token
+latency with and without the background refresh.
+
+    python benchmarks/stress_token_refresh.py [threads] [seconds]
+"""
+import json
+import sys
+from threading import Thread
+from time import perf_counter, sleep, time
+
+from mock_server import MockSpotify
+
+LIFETIME = 63 #valid for 3 seconds before get_token's 60 second margin
+LEAD = 61.5 #the background refresh replaces tokens 1.5 seconds in
+
+def hammer(auth, seconds:float, latencies:list):
+    worst = 0.0
+    scopes = ("user-library-read", None, "user-read-playback-state", None)
+    end = time() + seconds
+    calls = 0
+    while time() < end:
+        start = perf_counter()
+        token = auth.get_token(scopes[calls % 4])
+        worst = max(worst, perf_counter() - start)
+        assert token["access_token"]
+        calls += 1
+        sleep(0.001) #the request the token would be used for
+    latencies.append((worst, calls))
+
+def run(server:MockSpotify, threads:int, seconds:float, background:bool):
+    auth = server.api().auth
+    auth.store.tokens["expires_at"] = time() #starts expired
+    if background:
+        auth.get_token(None)
+        auth.get_token("user-library-read")
+        auth.start_background_refresh(LEAD)
+    before = server.token_requests
+    latencies = list()
+    workers = [Thread(target=hammer, args=(auth, seconds, latencies)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    auth.stop_background_refresh()
+    with open(auth.tokens_loc) as tokens_file:
+        json.load(tokens_file)
+    windows = seconds / (LIFETIME - (LEAD if background else 60)) + 1
+    requests = server.token_requests - before
+    print(f"  background refresh {'on ' if background else 'off'}: {sum(calls for _, calls in latencies):>9} calls, {requests:>3} token requests "
+          f"(at most {2 * int(windows) + 2} expected), worst get_token {max(worst for worst, _ in latencies) * 1000:.1f} ms, stats {auth.stats()}")
+    assert requests <= 2 * int(windows) + 2
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with MockSpotify(latency=0.05, token_lifetime=LIFETIME) as server:
+        print(f"{threads} threads for {seconds:.0f} s, 50 ms token endpoint, tokens valid for {LIFETIME - 60} s")
+        run(server, threads, seconds, False)
+        run(server, threads, seconds, True)
+
+if __name__ == "__main__":
+    main()
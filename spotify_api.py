@@ -1,78 +1,2329 @@
-from requests import Session
-from random import choice
+from requests import Session, Response
+from requests.structures import CaseInsensitiveDict
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, Future
+import asyncio
+from collections import deque, OrderedDict, Counter, defaultdict
+from itertools import islice
+from operator import itemgetter
+from bisect import bisect_left
+import heapq
+from array import array
+import sys
+import socket
+from random import choice, uniform
 from string import ascii_letters, digits
 import urllib.parse
-from selenium.webdriver import Firefox
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import webbrowser
 from base64 import b64encode
+from email.utils import parsedate_to_datetime
+from hashlib import sha1
 import json
-from time import time
-from os import path
+import gzip
+import zlib
+import sqlite3
+from time import time, monotonic, sleep, perf_counter
+from threading import Lock, Event, Thread, Condition
+from weakref import WeakValueDictionary
+from os import path, fdopen, replace, remove, makedirs, scandir
+from tempfile import mkstemp
+from zipfile import ZipFile, ZIP_STORED
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _atomic_write(loc:str, content, prefix:str="tmp"):
+    """
+    Write content (str or bytes) to loc through a temporary file in the same directory and a rename, so loc is never left half written.
+    """
+    descriptor, temp_loc = mkstemp(dir=path.dirname(path.abspath(loc)), prefix=prefix, suffix=".tmp")
+    try:
+        with fdopen(descriptor, "wb" if isinstance(content, bytes) else "w") as temp_file:
+            temp_file.write(content)
+        replace(temp_loc, loc)
+    except BaseException:
+        remove(temp_loc)
+        raise
+
+class TokenStore(object):
+    """
+    Keeps the current token in memory and persists it to a json file.
+    The file is only read once, on creation, and only written (atomically, through a temporary file and a rename) when the token actually changes.
+    """
+    def __init__(self, tokens_loc:str):
+        self.tokens_loc = tokens_loc
+        try:
+            with open(self.tokens_loc, "r") as tokens_file:
+                self.tokens = json.load(tokens_file)
+        except FileNotFoundError:
+            self.tokens = dict()
+
+    def save(self, tokens:dict):
+        if tokens == self.tokens:
+            return
+        self.tokens = tokens
+        if "refresh_token" not in tokens: #only user tokens are worth keeping between runs
+            return
+        _atomic_write(self.tokens_loc, json.dumps(tokens), ".tokens")
+
+class MemoryTokenStore(object):
+    """
+    Tokens of many users kept in memory (lost on exit), the default store of a ClientPool.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.tokens = dict()
+
+    def load(self, user:str):
+        with self.lock:
+            return self.tokens.get(user, dict())
+
+    def save(self, user:str, tokens:dict):
+        with self.lock:
+            self.tokens[user] = tokens
+
+    def users(self):
+        with self.lock:
+            return list(self.tokens)
+
+class SQLiteTokenStore(object):
+    """
+    Tokens of many users in one SQLite database, a row per user, so thousands of users do not need thousands of token files.
+    
+    Parameters:
+    
+        - database: Path of the database file, created if missing.
+    """
+    def __init__(self, database:str):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tokens (user TEXT PRIMARY KEY, tokens TEXT NOT NULL)")
+
+    def load(self, user:str):
+        with self.lock:
+            row = self.connection.execute("SELECT tokens FROM tokens WHERE user = ?", (user,)).fetchone()
+        return json.loads(row[0]) if row else dict()
+
+    def save(self, user:str, tokens:dict):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO tokens (user, tokens) VALUES (?, ?)", (user, json.dumps(tokens)))
+
+    def users(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT user FROM tokens")]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class UserTokens(object):
+    """
+    The tokens of one user of a shared store (MemoryTokenStore, SQLiteTokenStore or any object with load(user) and save(user, tokens)), with the interface of TokenStore.
+    """
+    def __init__(self, store, user:str):
+        self.store = store
+        self.user = user
+        self.tokens = store.load(user)
+
+    def save(self, tokens:dict):
+        if tokens == self.tokens:
+            return
+        self.tokens = tokens
+        if "refresh_token" in tokens: #only user tokens are worth keeping
+            self.store.save(self.user, tokens)
+
+class _HTTPServerV6(HTTPServer):
+    """
+    Loopback listener for an IPv6 redirect_uri like http://[::1]:8888/callback.
+    """
+    address_family = socket.AF_INET6
+
+class _RedirectHandler(BaseHTTPRequestHandler):
+    """
+    Answers the authorization redirect on the loopback listener and hands its query to the server.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path != self.server.callback_path:
+            self.send_error(404)
+            return
+        self.server.callback = dict(urllib.parse.parse_qsl(parsed.query))
+        body = b"Authorization received, you can close this window."
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
 class Auth(object):
-    def __init__(self, credentials:str, tokens_loc:str = None):
-        credentials = json.load(open(credentials))
-        self.session = Session()
+    """
+    Gets and keeps the tokens of one user.
+    
+    Parameters:
+    
+        - credentials: Path of the credentials file, or its content as a dict.
+        - tokens_loc: Path of the tokens file. Default: tokens.json next to this module.
+        - auth_mode: How the user authorization is caught:
+            - loopback: open the authorization page in the default browser and catch the redirect with a local listener on the redirect_uri port (redirect_uri has to be http://localhost:<port>/... or http://127.0.0.1:<port>/...);
+            - headless: print the authorization page, for servers: open it on any device and paste back the address it redirects to;
+            - browser: drive Firefox with selenium (needs selenium and the Firefox driver);
+            - none: never authorize interactively, raise instead, for services where the tokens come from elsewhere.
+        - auth_timeout: Seconds to wait for the user to authorize. Default: 300.
+        - session: Session the token requests are sent through. Default: a new one.
+        - store: Where the user token is kept, an object with the interface of TokenStore (like UserTokens). Default: a TokenStore on tokens_loc.
+        - client_auth: Auth whose client credentials token is used instead of getting one of its own, so users of the same application share it.
+    """
+    def __init__(self, credentials, tokens_loc:str = None, auth_mode:str = "loopback", auth_timeout:float = 300, session:Session = None, store = None, client_auth = None):
+        if not isinstance(credentials, dict):
+            with open(credentials) as credentials_file:
+                credentials = json.load(credentials_file)
+        self.session = session if session is not None else Session()
         self.user = credentials["user"]
         self.client_id = credentials["client_id"]
         self.client_secret = credentials["client_secret"]
         self.redirect_uri = credentials["redirect_uri"]
         self.show_dialog = "false" #add as opt
+        if auth_mode not in ("loopback", "headless", "browser", "none"):
+            raise Exception(f"{auth_mode} is not a valid auth mode")
+        self.auth_mode = auth_mode
+        self.auth_timeout = auth_timeout
+        self.authorize_url = "https://accounts.spotify.com/authorize"
+        self.token_url = "https://accounts.spotify.com/api/token"
         self.tokens_loc = tokens_loc if tokens_loc else path.join(path.dirname(path.abspath(__file__)), "tokens.json")
-        try:
-            self.tokens = json.load(open(self.tokens_loc, "r"))
-        except FileNotFoundError:
-            self.tokens = dict()
+        self.store = store if store is not None else TokenStore(self.tokens_loc)
+        self.client_auth = client_auth
+        self.client_token = dict()
+        self.scopes = set() #every scope asked for, so new authorizations ask for all of them at once
+        self.expiry_margin = 60
+        self.refreshes = 0
+        self.authorizations = 0
+        self.client_tokens = 0
+        self.locks = {"client":Lock(), "user":Lock()}
+        self._refresher = None
 
+    @property
+    def tokens(self):
+        return self.store.tokens
         
     def get_code(self, scope:str):
-        url = "https://accounts.spotify.com/authorize"
+        if self.auth_mode == "none":
+            raise Exception(f"User {self.user} has no valid token for {scope} and auth_mode none does not authorize interactively")
+        url = self.authorize_url
         state = "".join(choice(ascii_letters + digits) for i in range(10))
         parameters = urllib.parse.urlencode({"client_id":self.client_id, "response_type":"code", "redirect_uri":self.redirect_uri, "state":state, "scope":scope, "show_dialog": self.show_dialog})
-        with Firefox() as driver:
-            driver.get(url + "?" + parameters)
-            while self.redirect_uri + "?code" not in driver.current_url:
-                continue
-            response = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(driver.current_url).query))
-            driver.close()
-        if response["state"] != state:
+        if self.auth_mode == "browser":
+            response = self._code_from_browser(url + "?" + parameters)
+        elif self.auth_mode == "headless":
+            response = self._code_from_console(url + "?" + parameters)
+        else:
+            response = self._code_from_loopback(url + "?" + parameters)
+        if response.get("state") != state:
             raise Exception("State missmatch, possible man in the middle atack, please try again.")
+        if "error" in response:
+            raise Exception(f"Authorization failed: {response['error']}")
         return response["code"]
 
+    def _code_from_loopback(self, authorize_url:str):
+        redirect = urllib.parse.urlparse(self.redirect_uri)
+        if redirect.scheme != "http" or redirect.hostname not in ("localhost", "127.0.0.1", "::1"):
+            raise Exception(f"The loopback auth mode needs a http://localhost redirect_uri, got {self.redirect_uri}")
+        with (_HTTPServerV6 if ":" in redirect.hostname else HTTPServer)((redirect.hostname, redirect.port or 80), _RedirectHandler) as server:
+            server.callback_path = redirect.path or "/"
+            server.callback = None
+            server.timeout = self.auth_timeout
+            if not webbrowser.open(authorize_url):
+                print(f"Open this page to authorize the application:\n{authorize_url}")
+            deadline = time() + self.auth_timeout
+            while server.callback is None: #each handle_request blocks until a request arrives, stray ones (like favicon.ico) are answered and waited past
+                if time() > deadline:
+                    raise Exception("Timed out waiting for the authorization redirect.")
+                server.handle_request()
+            return server.callback
+
+    def _code_from_console(self, authorize_url:str):
+        print(f"Open this page on any device to authorize the application:\n{authorize_url}")
+        redirected = input("Then paste the address it redirected to: ").strip()
+        return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(redirected).query))
+
+    def _code_from_browser(self, authorize_url:str):
+        from selenium.webdriver import Firefox
+        from selenium.webdriver.support.ui import WebDriverWait
+        with Firefox() as driver:
+            driver.get(authorize_url)
+            WebDriverWait(driver, self.auth_timeout, poll_frequency=0.5).until(lambda driver: driver.current_url.startswith(self.redirect_uri + "?"))
+            return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(driver.current_url).query))
+
     def get_new_token(self, scope:str, refresh:bool):
-        url = "https://accounts.spotify.com/api/token"
+        """
+        Request a token: a refreshed user token, a client credentials token if scope is None, or else a user token for scope through a new authorization.
+        """
+        url = self.token_url
         header = b64encode((self.client_id + ':' + self.client_secret).encode("ascii")).decode('ascii')
         if refresh:
-            data = {"grant_type":"refresh_token", "refresh_token":json.load(open(self.tokens_loc, "r"))["refresh_token"], "scope":scope} if scope else {'grant_type': 'client_credentials'}
+            data = {"grant_type":"refresh_token", "refresh_token":self.tokens["refresh_token"]}
+            self.refreshes += 1
+        elif not scope:
+            data = {'grant_type': 'client_credentials'}
+            self.client_tokens += 1
         else:
-            data = {"grant_type":"authorization_code", "code":self.get_code(scope), "redirect_uri":self.redirect_uri} if scope else {'grant_type': 'client_credentials'}
+            data = {"grant_type":"authorization_code", "code":self.get_code(scope), "redirect_uri":self.redirect_uri}
+            self.authorizations += 1
         token = self.session.request("POST", url, data=data, headers={"Authorization": f"Basic {header}"})
+        if token.status_code != 200: #e.g. a revoked refresh token
+            raise Exception(f"Getting a token for {self.user or 'the client'} failed with status {token.status_code}: {token.text}")
         token = token.json()
         token["expires_at"] = time() + token["expires_in"]
+        if refresh:
+            token.setdefault("refresh_token", self.tokens["refresh_token"]) #spotify only sometimes rotates the refresh token
+            token.setdefault("scope", self.tokens.get("scope", ""))
+        return token
+
+    def cached_token(self, scope:str=None):
+        """
+        Return the token in memory that can be used for scope without going to the token endpoint, or None.
+        Client credentials calls (scope None) and user calls have separate tokens, a user token serves every scope it was granted.
+        """
+        if scope is None and self.client_auth is not None:
+            return self.client_auth.cached_token(None)
+        token = self.client_token if scope is None else self.store.tokens
+        if not token or token["expires_at"] - time() < self.expiry_margin:
+            return None
+        if scope is not None and not set(scope.split()) <= set(token.get("scope", "").split()):
+            return None
+        return token
+
+    def get_token(self, scope:str=None):
+        """
+        Get a valid token for the given scope.
+        The token in memory is returned as is while it is valid, the token endpoint and the tokens file are only touched when it has to be replaced:
+        an expiring token is refreshed, and a scope the user token was not granted is authorized together with every scope granted or asked for before, so alternating scopes do not replace each other.
+        
+        Parameters:
+        
+            - scope: A space-separated list of scopes. None for a client credentials token.
+        """
+        return self.fetch_token(scope)[0]
+
+    def fetch_token(self, scope:str=None):
+        """
+        Get a valid token for scope like get_token, returned as (token, requested): requested tells if this call went to the token endpoint for it.
+        """
+        if scope is None and self.client_auth is not None:
+            return self.client_auth.fetch_token(None)
+        token = self.cached_token(scope)
+        if token is not None:
+            return token, False
+        with self.locks["client" if scope is None else "user"]: #single flight: the threads that waited for the lock find the token the first one got
+            token = self.cached_token(scope)
+            if token is not None:
+                return token, False
+            return self._new_token(scope), True
+
+    def _new_token(self, scope:str=None):
+        if scope is None:
+            self.client_token = self.get_new_token(None, False)
+            return self.client_token
+        current = self.store.tokens
+        self.scopes.update(scope.split())
+        if current and "refresh_token" in current and self.scopes <= set(current.get("scope", "").split()):
+            token = self.get_new_token(scope, True)
+        else:
+            self.scopes.update(current.get("scope", "").split())
+            token = self.get_new_token(" ".join(sorted(self.scopes)), False)
+        self.store.save(token)
         return token
+
+    def start_background_refresh(self, lead:float=120):
+        """
+        Start a daemon thread that replaces the client and user tokens lead seconds before they expire, so requests never wait on the token endpoint.
+        lead has to be over expiry_margin, the point where get_token would refresh them itself.
+        
+        Parameters:
+        
+            - lead: Seconds before expiry a token is replaced. Default: 120.
+        """
+        if self._refresher is not None:
+            return
+        self._stop_refresh = Event()
+        self._refresher = Thread(target=self._refresh_loop, args=(lead,), daemon=True, name="token-refresh")
+        self._refresher.start()
+
+    def stop_background_refresh(self):
+        if self._refresher is None:
+            return
+        self._stop_refresh.set()
+        self._refresher.join()
+        self._refresher = None
+
+    def _refresh_loop(self, lead:float):
+        while not self._stop_refresh.is_set():
+            for slot in ("client", "user"):
+                with self.locks[slot]:
+                    token = self.client_token if slot == "client" else self.store.tokens
+                    if not token or token["expires_at"] - time() >= lead or slot == "user" and "refresh_token" not in token:
+                        continue
+                    try:
+                        if slot == "client":
+                            self.client_token = self.get_new_token(None, False)
+                        else:
+                            self.store.save(self.get_new_token(token.get("scope"), True))
+                    except Exception: #tried again on the next round, and get_token still refreshes by itself once the token is inside expiry_margin
+                        pass
+            pending = [token["expires_at"] - lead - time() for token in (self.client_token, self.store.tokens) if token]
+            self._stop_refresh.wait(max(1.0, min(pending)) if pending else 5.0)
+
+    def stats(self):
+        """
+        Number of token requests made: refreshes of the user token, new user authorizations and client credentials tokens.
+        """
+        return {"refreshes":self.refreshes, "authorizations":self.authorizations, "client_tokens":self.client_tokens}
+        
+class RequestScheduler(object):
+    """
+    Decides when requests can be sent, shared by every thread (and coroutine) of one or more Api.
+    A 429 pauses all callers for its Retry-After window, 429s and 5xxs on idempotent requests are retried with jittered exponential backoff, and an optional token bucket caps the request rate.
+    
+    Parameters:
+    
+        - rate: Maximum requests per second, None for no limit.
+        - burst: Requests that can be sent at once before rate applies. Default: rate.
+        - max_retries: Times a throttled or failed request is retried before its response is returned as is.
+        - backoff: Base of the exponential backoff, in seconds.
+        - max_backoff: Ceiling of the backoff, in seconds.
+    """
+    def __init__(self, rate:float=None, burst:int=None, max_retries:int=5, backoff:float=0.5, max_backoff:float=30.0):
+        self.rate = rate
+        self.burst = burst if burst else max(rate or 1, 1)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = Lock()
+        self.allowance = self.burst
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self):
+        """
+        Take a slot for one request and return the seconds the caller has to wait before sending it.
+        Slots are handed out in order, so callers are released spaced by the rate instead of all at once.
+        """
+        with self.lock:
+            now = monotonic()
+            start = max(now, self.paused_until)
+            if self.rate:
+                self.allowance = min(self.burst, self.allowance + (now - self.updated) * self.rate)
+                self.updated = now
+                self.allowance -= 1
+                if self.allowance < 0:
+                    start = max(start, now - self.allowance / self.rate)
+            self.requests += 1
+            wait = start - now
+            if wait > 0:
+                self.waiting += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def done_waiting(self):
+        with self.lock:
+            self.waiting -= 1
+
+    def retry_delay(self, request_type:str, response, attempt:int):
+        """
+        Seconds to wait before retrying the request that got response, None if it should not be retried.
+        A 429 pauses every caller of the scheduler until its Retry-After has passed.
+        """
+        if attempt >= self.max_retries:
+            return None
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            with self.lock:
+                self.throttled += 1
+                self.retries += 1
+                seconds = self._seconds_until(retry_after) if retry_after is not None else None
+                if seconds is not None:
+                    self.paused_until = max(self.paused_until, monotonic() + seconds)
+            return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if response.status_code >= 500 and request_type.upper() in ("GET", "PUT", "DELETE"):
+            with self.lock:
+                self.retries += 1
+            return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return None
+
+    @staticmethod
+    def _seconds_until(retry_after:str):
+        """
+        Seconds a Retry-After header asks to wait: a number of seconds or an HTTP date, None if it is neither (the backoff delay applies then).
+        """
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time())
+        except (TypeError, ValueError):
+            return None
+
+    def wait(self):
+        wait = self.reserve()
+        if wait > 0:
+            try:
+                sleep(wait)
+            finally:
+                self.done_waiting()
+
+    async def wait_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.done_waiting()
+
+    def stats(self):
+        """
+        Snapshot of the scheduler: requests scheduled, callers waiting right now (queue depth), 429s seen, retries and time spent waiting.
+        """
+        with self.lock:
+            return {"requests":self.requests, "waiting":self.waiting, "throttled":self.throttled, "retries":self.retries,
+                    "wait_time":self.wait_time, "max_wait":self.max_wait, "paused_for":max(0.0, self.paused_until - monotonic())}
+
+class ResponseCache(object):
+    """
+    Cache of GET response bodies and their ETags.
+    Catalog and browse responses (fresh_endpoints) younger than ttl are served without a request, older ones are revalidated with If-None-Match and served from the cache on a 304.
+    Responses of other endpoints, like playlists and the library of the user, change any time and are revalidated on every request, and the playback state (uncached_endpoints) is never cached.
+    The in-memory tier is a LRU bounded by the size of the bodies, the optional on-disk tier keeps responses between runs and is a LRU bounded by the size of its files.
+    
+    Parameters:
+    
+        - max_bytes: Maximum size of the bodies kept in memory. Default: 64MB.
+        - ttl: Seconds a response of fresh_endpoints is served without revalidation. Default: 60.
+        - directory: Directory of the on-disk tier, None to keep responses in memory only.
+        - max_disk_bytes: Maximum size of the files of the on-disk tier. Default: 256MB.
+    """
+    fresh_endpoints = ("albums", "artists", "tracks", "episodes", "shows", "audio-features", "audio-analysis", "browse", "markets")
+    uncached_endpoints = ("me/player",)
+
+    def __init__(self, max_bytes:int=64 * 2 ** 20, ttl:float=60, directory:str=None, max_disk_bytes:int=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict() #key -> (etag, content, stored_at)
+        self.size = 0
+        self.disk = OrderedDict() #file name -> size, least recently used first
+        self.disk_size = 0
+        if directory:
+            self._scan_disk()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.not_modified = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    @staticmethod
+    def key(user:str, url:str, params:dict=None):
+        return f"{user or ''} {url}?{urllib.parse.urlencode(sorted((params or {}).items()))}"
+
+    def ttl_for(self, url:str):
+        """
+        Seconds the response of url is served without revalidation: ttl for fresh_endpoints, 0 for other endpoints, None when it is not cached at all.
+        """
+        if url.startswith(self.uncached_endpoints):
+            return None
+        return self.ttl if url.split("/", 1)[0] in self.fresh_endpoints else 0
+
+    def _scan_disk(self):
+        try:
+            files = sorted((entry.stat().st_mtime, entry.name, entry.stat().st_size) for entry in scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp"))
+        except FileNotFoundError:
+            return
+        for _, name, size in files:
+            self.disk[name] = size
+            self.disk_size += size
+
+    def _disk_loc(self, key:str):
+        return path.join(self.directory, sha1(key.encode()).hexdigest())
+
+    def _remember(self, key:str, entry:tuple):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[1])
+        if len(entry[1]) > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.size += len(entry[1])
+        while self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1][1])
+            self.evictions += 1
+
+    def _read_disk(self, key:str):
+        try:
+            with open(self._disk_loc(key), "rb") as cache_file:
+                header = json.loads(cache_file.readline())
+                content = cache_file.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        with self.lock:
+            name = path.basename(self._disk_loc(key))
+            if name in self.disk:
+                self.disk.move_to_end(name)
+        return (header["etag"], content, header["stored_at"]) if header["key"] == key else None
+
+    def _write_disk(self, key:str, entry:tuple):
+        content = json.dumps({"key":key, "etag":entry[0], "stored_at":entry[2]}).encode() + b"\n" + entry[1]
+        if len(content) > self.max_disk_bytes:
+            return
+        loc = self._disk_loc(key)
+        with self.lock: #the file is made the most recent before it is written, so the evictions below never pick it
+            name = path.basename(loc)
+            self.disk_size += len(content) - self.disk.pop(name, 0)
+            self.disk[name] = len(content)
+            while self.disk_size > self.max_disk_bytes:
+                evicted, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                self.disk_evictions += 1
+                try:
+                    remove(path.join(self.directory, evicted))
+                except FileNotFoundError:
+                    pass
+        _atomic_write(loc, content)
+
+    def lookup(self, key:str, ttl:float=None):
+        """
+        Return (etag, content, fresh) for the cached response of key, or None if there is none.
+        A response is fresh when it is younger than ttl, self.ttl by default.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.directory:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self._remember(key, entry)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            fresh = time() - entry[2] < (self.ttl if ttl is None else ttl)
+            if fresh:
+                self.hits += 1
+            elif entry[0]:
+                self.revalidations += 1
+            else:
+                self.misses += 1
+            return entry[0], entry[1], fresh
+
+    def store(self, key:str, etag:str, content:bytes):
+        entry = (etag, content, time())
+        with self.lock:
+            self._remember(key, entry)
+        if self.directory:
+            self._write_disk(key, entry)
+
+    def revalidated(self, key:str, etag:str, content:bytes):
+        """
+        Record a 304 for key: the cached body is still current, so its ttl starts again.
+        """
+        with self.lock:
+            self.not_modified += 1
+        self.store(key, etag, content)
+
+    def stats(self):
+        with self.lock:
+            return {"entries":len(self.entries), "bytes":self.size, "hits":self.hits, "misses":self.misses, "revalidations":self.revalidations,
+                    "not_modified":self.not_modified, "disk_hits":self.disk_hits, "evictions":self.evictions, "disk_bytes":self.disk_size, "disk_evictions":self.disk_evictions}
+
+class EntityCache(object):
+    """
+    Catalog objects (track, album, artist, episode, audio_features) by type and Spotify ID, so multi-ID lookups only request the IDs it does not have.
+    Besides the multi-ID responses, it is filled with the full objects other responses carry: the tracks of playlist and saved track items, top tracks,
+    related, followed and top artists, and the tracks and artists found by search. Simplified objects (the album of a track, the artists and tracks of an album)
+    can not answer a lookup and are never kept.
+    
+    Parameters:
+    
+        - max_entries: Maximum number of objects kept, the least recently used are dropped first. Default: 100000.
+        - ttl: Seconds an object is kept, None to keep it until it is dropped.
+    """
+    def __init__(self, max_entries:int=100000, ttl:float=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict() #(type, id) -> (object, stored_at)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.harvested = 0
+
+    def get(self, type_of:str, entity_id:str):
+        """
+        Return the cached object for the given type and ID, or None.
+        
+        Parameters:
+        
+            - type_of: track, album, artist, episode or audio_features.
+            - entity_id: The Spotify ID.
+        """
+        with self.lock:
+            entry = self.entries.get((type_of, entity_id))
+            if entry is not None and self.ttl is not None and time() - entry[1] > self.ttl:
+                del self.entries[(type_of, entity_id)]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((type_of, entity_id))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, type_of:str, entity:dict):
+        """
+        Store a full object.
+        """
+        key = (type_of, entity.get("id"))
+        if key[1] is None:
+            return
+        with self.lock:
+            self._put(key, entity)
+            self.stored += 1
+
+    def _put(self, key:tuple, entity:dict):
+        self.entries[key] = (entity, time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def harvest(self, type_of:str, entities):
+        """
+        Store the full objects of type_of found nested in another response. Relinked tracks (with linked_from) are skipped,
+        and the market dependent fields (is_playable, restrictions) are left out, as lookups are not made for a market.
+        """
+        entities = [entity for entity in entities if isinstance(entity, dict) and entity.get("type") == type_of and entity.get("id") and "linked_from" not in entity]
+        with self.lock:
+            for entity in entities:
+                if "is_playable" in entity or "restrictions" in entity:
+                    entity = {key:value for key, value in entity.items() if key not in ("is_playable", "restrictions")}
+                self._put((type_of, entity["id"]), entity)
+            self.harvested += len(entities)
+
+    def stats(self):
+        with self.lock:
+            return {"entries":len(self.entries), "hits":self.hits, "misses":self.misses, "stored":self.stored, "harvested":self.harvested}
+
+class Instrumentation(object):
+    """
+    Counters and latency histograms of the requests made by an Api, by verb and logical endpoint (playlists/{id}/tracks rather than the url), plus the time spent getting tokens, kept apart from the HTTP time.
+    Hooks are called around every HTTP request: before(verb, endpoint, url, params) and after(verb, endpoint, status, seconds, size).
+    A request that raised instead of getting a response (a connection error or a timeout) is recorded with status 0 and counted as an error.
+    
+        instrumentation = Instrumentation()
+        api = Api("credentials.json", instrumentation=instrumentation)
+        ...
+        instrumentation.snapshot() #or instrumentation.prometheus() for a scrape endpoint
+    
+    Parameters:
+    
+        - buckets: Upper bounds, in seconds, of the latency histogram buckets.
+    """
+    id_parents = ("albums", "artists", "audio-analysis", "audio-features", "episodes", "playlists", "shows", "tracks", "users")
+
+    def __init__(self, buckets:tuple=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.endpoints = dict() #(verb, endpoint) -> {"count", "errors", "statuses", "bytes", "seconds", "max", "histogram"}
+        self.token = self._new_stats()
+        self.token["requests"] = 0
+        self.before_hooks = list()
+        self.after_hooks = list()
+
+    def _new_stats(self):
+        return {"count":0, "errors":0, "statuses":Counter(), "bytes":0, "seconds":0.0, "max":0.0, "histogram":[0] * (len(self.buckets) + 1)}
+
+    def add_hooks(self, before=None, after=None):
+        """
+        Register functions called before and after every HTTP request.
+        
+        Parameters:
+        
+            - before: Called as before(verb, endpoint, url, params).
+            - after: Called as after(verb, endpoint, status, seconds, size).
+        """
+        if before:
+            self.before_hooks.append(before)
+        if after:
+            self.after_hooks.append(after)
+
+    @classmethod
+    def endpoint(cls, url:str):
+        """
+        Logical endpoint of a request url relative to the base url, with the IDs replaced by {id}, e.g. playlists/{id}/tracks.
+        """
+        parts = url.split("?")[0].strip("/").split("/")
+        for index in range(1, len(parts)):
+            if index == 1 and parts[0] in cls.id_parents or index == 2 and parts[:2] == ["browse", "categories"]:
+                parts[index] = "{id}"
+        return "/".join(parts)
+
+    def _record(self, stats:dict, seconds:float):
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+        stats["histogram"][bisect_left(self.buckets, seconds)] += 1
+
+    def before(self, verb:str, url:str, params:dict=None):
+        endpoint = self.endpoint(url)
+        for hook in self.before_hooks:
+            hook(verb, endpoint, url, params)
+        return endpoint
+
+    def record_request(self, verb:str, endpoint:str, status:int, seconds:float, size:int):
+        with self.lock:
+            stats = self.endpoints.get((verb, endpoint))
+            if stats is None:
+                stats = self.endpoints[(verb, endpoint)] = self._new_stats()
+            self._record(stats, seconds)
+            stats["statuses"][status] += 1
+            stats["errors"] += status == 0 or status >= 400
+            stats["bytes"] += size
+        for hook in self.after_hooks:
+            hook(verb, endpoint, status, seconds, size)
+
+    def record_token(self, seconds:float, requested:bool):
+        """
+        Record the time get_token took, requested tells if it had to go to the token endpoint.
+        """
+        with self.lock:
+            self._record(self.token, seconds)
+            self.token["requests"] += requested
+
+    def _quantile(self, histogram:list, quantile:float):
+        target = quantile * sum(histogram)
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if count and seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return 0.0
+
+    def _export(self, stats:dict):
+        exported = {key:value for key, value in stats.items() if key not in ("statuses", "histogram")}
+        exported.update(mean=stats["seconds"] / stats["count"] if stats["count"] else 0.0, p50=self._quantile(stats["histogram"], 0.5), p99=self._quantile(stats["histogram"], 0.99),
+                        histogram=dict(zip([*map(str, self.buckets), "+Inf"], stats["histogram"])))
+        if "statuses" in stats:
+            exported["statuses"] = dict(stats["statuses"])
+        return exported
+
+    def snapshot(self):
+        """
+        Copy of every counter: {"endpoints": {"<verb> <endpoint>": {...}}, "token": {...}}, latencies in seconds, p50/p99 are histogram bucket bounds.
+        """
+        with self.lock:
+            return {"endpoints":{f"{verb} {endpoint}":self._export(stats) for (verb, endpoint), stats in self.endpoints.items()}, "token":self._export(self.token)}
+
+    def prometheus(self, prefix:str="spotify_api"):
+        """
+        The counters in the Prometheus text exposition format.
+        """
+        lines = list()
+        def histogram(name:str, labels:str, stats:dict):
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], stats["histogram"]):
+                cumulative += count
+                lines.append(f'{prefix}_{name}_seconds_bucket{{{labels}le="{bound}"}} {cumulative}')
+            plain = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{prefix}_{name}_seconds_sum{plain} {stats['seconds']}")
+            lines.append(f"{prefix}_{name}_seconds_count{plain} {stats['count']}")
+        with self.lock:
+            for (verb, endpoint), stats in sorted(self.endpoints.items()):
+                labels = f'verb="{verb}",endpoint="{endpoint}",'
+                for status, count in sorted(stats["statuses"].items()):
+                    lines.append(f'{prefix}_responses_total{{{labels}status="{status}"}} {count}')
+                lines.append(f"{prefix}_response_bytes_total{{{labels.rstrip(',')}}} {stats['bytes']}")
+                histogram("request", labels, stats)
+            histogram("token", "", self.token)
+            lines.append(f"{prefix}_token_requests_total {self.token['requests']}")
+        return "\n".join(lines) + "\n"
+
+class AudioAnalysis(object):
+    """
+    Columnar form of an audio analysis: one float32 array per numeric field of bars, beats, tatums, sections and segments, and N×12 matrices for the segment pitches and timbre.
+    Columns are attributes named <part>_<field>, e.g. segments_start, segments_loudness_max, segments_pitches or sections_tempo; track holds the scalar fields of the track part.
+    """
+    intervals = ("start", "duration", "confidence")
+    fields = {"bars":intervals, "beats":intervals, "tatums":intervals,
+              "sections":intervals + ("loudness", "tempo", "tempo_confidence", "key", "key_confidence", "mode", "mode_confidence", "time_signature", "time_signature_confidence"),
+              "segments":intervals + ("loudness_start", "loudness_max_time", "loudness_max", "loudness_end")}
+
+    def __init__(self, columns:dict, track:dict):
+        self.columns = columns
+        self.track = track
+
+    def __getattr__(self, name:str):
+        try:
+            return self.__dict__["columns"][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    @classmethod
+    def from_json(cls, analysis):
+        """
+        Build the columnar form of an audio analysis.
+        A json body is decoded in one pass: every bar, beat, tatum, section and segment is written to the row buffers of its kind as soon as it is decoded
+        (pitches and timbre 12 values per row) and its dict dropped, so the dict form of the whole analysis is never built.
+        
+        Parameters:
+        
+            - analysis: The audio analysis as returned by get_audio_analysis, either the json body (str or bytes) or the decoded dict.
+        """
+        if np is None:
+            raise Exception("AudioAnalysis needs numpy, install it with: pip install numpy")
+        kinds = {kind:(fields, itemgetter(*fields), array("f")) for kind, fields in (("intervals", cls.intervals), ("sections", cls.fields["sections"]), ("segments", cls.fields["segments"]))}
+        pitches, timbre = array("f"), array("f")
+        def add_row(kind:str, item:dict):
+            fields, getter, rows = kinds[kind]
+            try:
+                rows.fromlist(list(getter(item))) #fromlist leaves the rows unchanged when a value is not a number
+            except (KeyError, TypeError):
+                rows.fromlist([float("nan") if value is None else value for value in map(item.get, fields)])
+        def add(item:dict):
+            """
+            Object hook: intervals (bars, beats and tatums, told apart afterwards by the lengths of their lists), sections and segments go to the rows, other objects are kept.
+            """
+            if "start" not in item:
+                return item
+            if len(item) <= len(cls.intervals):
+                add_row("intervals", item)
+            elif "pitches" in item or "timbre" in item or "loudness_max" in item:
+                for field, values in (("pitches", pitches), ("timbre", timbre)):
+                    row = item.get(field) or ()
+                    if len(row) != 12:
+                        raise Exception(f"Segment {len(kinds['segments'][2]) // len(cls.fields['segments'])} of the audio analysis has {len(row)} {field} values instead of 12")
+                    values.fromlist(list(row))
+                add_row("segments", item)
+            else:
+                add_row("sections", item)
+        if isinstance(analysis, (str, bytes)):
+            analysis = json.loads(analysis, object_hook=add)
+        else:
+            for part in analysis:
+                if part in cls.fields:
+                    for item in analysis[part] or ():
+                        add(item)
+        def block(rows:array, width:int):
+            return np.frombuffer(rows, dtype=np.float32).reshape(-1, width).T.copy() #one contiguous row per field
+        columns = dict()
+        intervals, start = block(kinds["intervals"][2], len(cls.intervals)), 0
+        for part in analysis: #in the order they were decoded
+            if part in ("bars", "beats", "tatums"):
+                count = len(analysis[part] or ())
+                columns.update((f"{part}_{field}", column[start:start + count]) for field, column in zip(cls.intervals, intervals))
+                start += count
+        for part in ("sections", "segments"):
+            columns.update((f"{part}_{field}", column) for field, column in zip(cls.fields[part], block(kinds[part][2], len(cls.fields[part]))))
+        for part in ("bars", "beats", "tatums"):
+            columns.update((f"{part}_{field}", np.zeros(0, dtype=np.float32)) for field in cls.intervals if f"{part}_{field}" not in columns)
+        columns["segments_pitches"] = np.frombuffer(pitches, dtype=np.float32).reshape(-1, 12)
+        columns["segments_timbre"] = np.frombuffer(timbre, dtype=np.float32).reshape(-1, 12)
+        track = {key:value for key, value in (analysis.get("track") or {}).items() if not isinstance(value, str) or not key.endswith("string")} #the codestrings are big and of no use here
+        return cls(columns, track)
+
+    def save(self, file:str):
+        """
+        Save the columns to an uncompressed .npz file, which load can memory-map.
+        """
+        np.savez(file, track=np.frombuffer(json.dumps(self.track).encode(), dtype=np.uint8), **self.columns)
+
+    @classmethod
+    def load(cls, file:str, mmap:bool=False):
+        """
+        Load an AudioAnalysis saved with save.
+        
+        Parameters:
+        
+            - file: Path of the .npz file.
+            - mmap: Map the columns from the file instead of reading them into memory.
+        """
+        if np is None:
+            raise Exception("AudioAnalysis needs numpy, install it with: pip install numpy")
+        if not mmap:
+            with np.load(file) as arrays:
+                columns = {name:arrays[name] for name in arrays.files}
+        else:
+            columns = dict()
+            with ZipFile(file) as archive, open(file, "rb") as raw:
+                for info in archive.infolist():
+                    if info.compress_type != ZIP_STORED:
+                        raise Exception(f"{info.filename} is compressed and can not be memory-mapped")
+                    raw.seek(info.header_offset + 26)
+                    name_length, extra_length = np.frombuffer(raw.read(4), dtype="<u2")
+                    raw.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+                    version = np.lib.format.read_magic(raw)
+                    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                    shape, fortran_order, dtype = read_header(raw)
+                    columns[info.filename[:-4]] = np.memmap(file, dtype=dtype, mode="r", offset=raw.tell(), shape=shape, order="F" if fortran_order else "C")
+        track = json.loads(bytes(columns.pop("track")))
+        return cls(columns, track)
+
+class AudioFeatureStore(object):
+    """
+    Local store of audio features, filled from get_audio_features.
+    The features are kept as a float32 matrix (one row per track, one column per feature in columns) memory-mapped from features.f32, and the track IDs, in row order, in ids.txt.
+    Tracks Spotify has no features for are stored as rows of NaN, so they are not requested again.
+    
+        store = AudioFeatureStore("features", api)
+        matrix = store.get(track_ids) #len(track_ids) × len(store.columns)
+    
+    Parameters:
+    
+        - directory: Directory of the store, created if missing.
+        - api: Api used to fetch the features of unknown tracks, None to only read the store.
+    """
+    columns = ("danceability", "energy", "key", "loudness", "mode", "speechiness", "acousticness", "instrumentalness", "liveness", "valence", "tempo", "duration_ms", "time_signature")
+
+    def __init__(self, directory:str, api=None):
+        if np is None:
+            raise Exception("AudioFeatureStore needs numpy, install it with: pip install numpy")
+        makedirs(directory, exist_ok=True)
+        self.api = api
+        self.lock = Lock()
+        self.features_loc = path.join(directory, "features.f32")
+        self.ids_loc = path.join(directory, "ids.txt")
+        try:
+            with open(self.ids_loc, "r") as ids_file:
+                ids = ids_file.read().split()
+        except FileNotFoundError:
+            ids = list()
+        self.index = {track_id:row for row, track_id in enumerate(ids)}
+        self.matrix = None
+        self._map(max(len(ids), path.getsize(self.features_loc) // (4 * len(self.columns)) if path.exists(self.features_loc) else 0))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, track_id:str):
+        return track_id in self.index
+
+    def _map(self, capacity:int):
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.matrix = None
+        with open(self.features_loc, "ab") as features_file:
+            features_file.truncate(capacity * 4 * len(self.columns))
+        self.capacity = capacity
+        if capacity:
+            self.matrix = np.memmap(self.features_loc, dtype=np.float32, mode="r+", shape=(capacity, len(self.columns)))
+
+    def append(self, track_ids:list, features:list):
+        """
+        Add the features of tracks that are not in the store yet.
+        
+        Parameters:
+        
+            - track_ids: The Spotify IDs of the tracks.
+            - features: Their audio features objects, in the same order. None for tracks without features.
+        """
+        with self.lock:
+            new = [(track_id, feature) for track_id, feature in dict(zip(track_ids, features)).items() if track_id not in self.index]
+            if not new:
+                return
+            start = len(self.index)
+            if start + len(new) > self.capacity:
+                self._map(max(start + len(new), 2 * self.capacity, 1024))
+            for row, (track_id, feature) in enumerate(new, start):
+                self.matrix[row] = [feature.get(column, np.nan) if feature else np.nan for column in self.columns]
+            self.matrix.flush()
+            with open(self.ids_loc, "a") as ids_file: #rows are written before their ids, an interrupted append leaves unused rows but no wrong ones
+                ids_file.write("".join(f"{track_id}\n" for track_id, _ in new))
+            self.index.update((track_id, row) for row, (track_id, _) in enumerate(new, start))
+
+    def get(self, track_ids:list, fetch:bool=True):
+        """
+        Return the features of track_ids as a len(track_ids) × len(columns) float32 matrix.
+        
+        Parameters:
+        
+            - track_ids: The Spotify IDs of the tracks.
+            - fetch: Fetch the tracks missing from the store with get_audio_features_bulk and add them. If False (or the store has no api) their rows are NaN.
+        """
+        missing = list(dict.fromkeys(track_id for track_id in track_ids if track_id not in self.index))
+        if missing and fetch and self.api is not None:
+            self.append(missing, self.api.get_audio_features_bulk(missing))
+        with self.lock:
+            rows = np.array([self.index.get(track_id, -1) for track_id in track_ids], dtype=np.int64)
+            result = np.full((len(track_ids), len(self.columns)), np.nan, dtype=np.float32)
+            if self.matrix is not None:
+                known = rows >= 0
+                result[known] = self.matrix[rows[known]]
+            return result
+
+class PlaybackWatcher(object):
+    """
+    Follows the playback of many users from one thread (or event loop) and only reports changes.
+    Each user is polled again when their current track should end (capped by max_interval so skips are still seen), paused and idle users every idle_interval.
+    Handlers are called as handler(user, event, playback) with event one of events and playback the playback state object (None once stopped).
+    
+        watcher = PlaybackWatcher()
+        watcher.on(lambda user, event, playback: print(user, event))
+        watcher.add_user("alice", alice_api)
+        watcher.start() #or await watcher.run_async() with AsyncApi clients
+    
+    Parameters:
+    
+        - min_interval: Shortest time between two polls of a user, in seconds.
+        - max_interval: Longest time between two polls of a playing user, in seconds.
+        - idle_interval: Time between two polls of a paused or idle user, in seconds.
+        - margin: Seconds past the expected end of the track the next poll is made at.
+        - seek_tolerance: Milliseconds the progress can differ from the expected one before it counts as a seek.
+    """
+    events = ("track_changed", "paused", "resumed", "device_changed", "seek", "stopped")
+
+    def __init__(self, min_interval:float=1.0, max_interval:float=30.0, idle_interval:float=15.0, margin:float=0.5, seek_tolerance:int=3000):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_interval = idle_interval
+        self.margin = margin
+        self.seek_tolerance = seek_tolerance
+        self.lock = Lock()
+        self.users = dict() #user: {"api", "market", "state", "due"}
+        self.queue = list() #heap of (due, sequence, user), entries whose due is no longer the user's are skipped
+        self.sequence = 0
+        self.handlers = list()
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+        self.polls = 0
+        self.idle = 0
+        self.unchanged = 0
+        self.errors = 0
+        self.emitted = Counter()
+
+    def on(self, handler):
+        """
+        Register handler(user, event, playback), called from the polling thread (or event loop) for every change.
+        """
+        self.handlers.append(handler)
+        return handler
+
+    def add_user(self, user, api, market:str=None):
+        """
+        Start watching a user, polled right away.
+        
+        Parameters:
+        
+            - user: Any hashable key the events are reported with.
+            - api: The user's Api (AsyncApi for run_async), authorized with user-read-playback-state.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+        """
+        with self.lock:
+            self.users[user] = {"api":api, "market":market, "state":None, "due":None}
+            self._schedule(user, 0)
+        self._wake.set()
+
+    def remove_user(self, user):
+        with self.lock:
+            self.users.pop(user, None)
+
+    def _schedule(self, user, delay:float):
+        due = monotonic() + delay
+        self.users[user]["due"] = due
+        self.sequence += 1
+        heapq.heappush(self.queue, (due, self.sequence, user))
+
+    def _take_due(self):
+        """
+        Pop the users due for a poll, return them with the seconds until the next one is.
+        """
+        with self.lock:
+            now = monotonic()
+            due = list()
+            while self.queue and self.queue[0][0] <= now:
+                at, _, user = heapq.heappop(self.queue)
+                if user in self.users and self.users[user]["due"] == at:
+                    self.users[user]["due"] = None
+                    due.append(user)
+            return due, (self.queue[0][0] - now if self.queue else self.idle_interval)
+
+    def interval(self, state:dict):
+        """
+        Seconds until a user with state (the summary of their last playback) is polled again.
+        """
+        if state is None or not state["playing"] or not state["duration"]:
+            return self.idle_interval
+        remaining = (state["duration"] - state["progress"]) / 1000
+        return min(self.max_interval, max(self.min_interval, remaining + self.margin))
+
+    def changes(self, previous:dict, state:dict):
+        """
+        Events between two playback summaries.
+        """
+        if state is None:
+            return ["stopped"] if previous is not None else []
+        if previous is None:
+            return ["track_changed"] if state["item"] else []
+        changes = list()
+        if state["item"] != previous["item"]:
+            changes.append("track_changed")
+        if state["device"] != previous["device"]:
+            changes.append("device_changed")
+        if state["playing"] != previous["playing"]:
+            changes.append("resumed" if state["playing"] else "paused")
+        elif state["item"] == previous["item"]:
+            expected = previous["progress"] + ((state["at"] - previous["at"]) * 1000 if state["playing"] else 0)
+            if abs(state["progress"] - expected) > self.seek_tolerance:
+                changes.append("seek")
+        return changes
+
+    def _update(self, user, response):
+        """
+        Handle the get_playback_info response of a user: reschedule them and emit what changed.
+        204s (nothing playing) are never parsed, and only a small summary of each state is kept between polls.
+        """
+        with self.lock:
+            self.polls += 1
+            entry = self.users.get(user)
+            if entry is None:
+                return []
+            if response.status_code not in (200, 204):
+                self.errors += 1
+                self._schedule(user, self.max_interval)
+                return []
+            playback = response.json() if response.status_code == 200 else None
+            if playback is not None and not playback.get("device") and not playback.get("item"):
+                playback = None
+            self.idle += playback is None
+            state = None
+            if playback is not None:
+                item = playback.get("item") or {}
+                state = {"item":item.get("id") or item.get("uri"), "device":(playback.get("device") or {}).get("id"), "playing":bool(playback.get("is_playing")),
+                         "progress":playback.get("progress_ms") or 0, "duration":item.get("duration_ms") or 0, "at":monotonic()}
+            changes = self.changes(entry["state"], state)
+            entry["state"] = state
+            self._schedule(user, self.interval(state))
+            self.unchanged += not changes
+            self.emitted.update(changes)
+        for event in changes:
+            for handler in self.handlers:
+                handler(user, event, playback)
+        return changes
+
+    def poll(self, user):
+        """
+        Poll one user now, return the events it produced.
+        """
+        entry = self.users[user]
+        return self._update(user, entry["api"].get_playback_info(entry["market"]))
+
+    async def poll_async(self, user):
+        entry = self.users[user]
+        return self._update(user, await entry["api"].get_playback_info(entry["market"]))
+
+    def run(self):
+        """
+        Poll the users as they come due until stop is called.
+        """
+        while not self._stop.is_set():
+            self._wake.clear()
+            due, wait = self._take_due()
+            for user in due:
+                try:
+                    self.poll(user)
+                except Exception: #connection errors, the user is tried again later
+                    with self.lock:
+                        self.errors += 1
+                        if user in self.users:
+                            self._schedule(user, self.max_interval)
+            if not due:
+                self._wake.wait(wait)
+
+    async def run_async(self):
+        """
+        Poll the users (with AsyncApi clients) as they come due until stop is called, those due at the same time concurrently.
+        """
+        while not self._stop.is_set():
+            due, wait = self._take_due()
+            for user, result in zip(due, await asyncio.gather(*map(self.poll_async, due), return_exceptions=True)):
+                if isinstance(result, Exception):
+                    with self.lock:
+                        self.errors += 1
+                        if user in self.users:
+                            self._schedule(user, self.max_interval)
+            if not due:
+                await asyncio.sleep(min(wait, self.min_interval)) #users added meanwhile are picked up within min_interval
+
+    def start(self):
+        """
+        Run the watcher in a daemon thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self.run, daemon=True, name="playback-watcher")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """
+        Snapshot of the watcher: users watched, polls made, polls with nothing playing, polls without any change, errors and events emitted by type.
+        """
+        with self.lock:
+            return {"users":len(self.users), "polls":self.polls, "idle":self.idle, "unchanged":self.unchanged, "errors":self.errors, "events":dict(self.emitted)}
+
+class ArtistGraph(object):
+    """
+    Related-artist graph in compressed sparse row form: the artists are numbered 0..n-1 and the related artists of artist i are indices[indptr[i]:indptr[i + 1]].
+    ids, depths, popularity and names are indexed the same way, popularity is -1 and names empty where unknown.
+    Saved as nodes.tsv (one "id, depth, popularity, name" line per artist) next to indptr.i64 and indices.i32, raw little-endian arrays that can be memory-mapped with numpy.
+    """
+    def __init__(self, ids:list, indptr, indices, depths=None, popularity=None, names:list=None):
+        self.ids = ids
+        self.index = {artist_id:node for node, artist_id in enumerate(ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.depths = depths if depths is not None else array("b", [0] * len(ids))
+        self.popularity = popularity if popularity is not None else array("b", [-1] * len(ids))
+        self.names = names if names is not None else [""] * len(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def edges(self):
+        return int(self.indptr[-1]) if len(self.indptr) else 0
+
+    def neighbors(self, artist_id:str):
+        """
+        The IDs of the related artists of artist_id that are in the graph.
+        """
+        node = self.index[artist_id]
+        return [self.ids[target] for target in self.indices[self.indptr[node]:self.indptr[node + 1]]]
+
+    def save(self, directory:str):
+        makedirs(directory, exist_ok=True)
+        _write_nodes(path.join(directory, "nodes.tsv"), "w", zip(self.ids, self.depths, self.popularity, self.names))
+        for name, values, typecode in (("indptr.i64", self.indptr, "q"), ("indices.i32", self.indices, "i")):
+            values = array(typecode, values)
+            if sys.byteorder != "little":
+                values.byteswap()
+            with open(path.join(directory, name), "wb") as f:
+                values.tofile(f)
+
+    @classmethod
+    def load(cls, directory:str, mmap:bool=False):
+        """
+        Read a saved graph, with mmap (needs numpy) indptr and indices are memory-mapped instead of read.
+        """
+        ids, depths, popularity, names, _ = _read_nodes(path.join(directory, "nodes.tsv"))
+        arrays = list()
+        for name, typecode, dtype in (("indptr.i64", "q", "<i8"), ("indices.i32", "i", "<i4")):
+            file = path.join(directory, name)
+            if mmap:
+                if np is None:
+                    raise Exception("Memory-mapping a graph needs numpy, install it with: pip install numpy")
+                arrays.append(np.memmap(file, dtype=dtype, mode="r") if path.getsize(file) else np.zeros(0, dtype=dtype))
+                continue
+            values = array(typecode)
+            with open(file, "rb") as f:
+                values.frombytes(f.read())
+            if sys.byteorder != "little":
+                values.byteswap()
+            arrays.append(values)
+        return cls(ids, *arrays, depths=depths, popularity=popularity, names=names)
+
+def _write_nodes(file:str, mode:str, nodes):
+    with open(file, mode, encoding="utf-8", newline="\n") as f:
+        f.write("".join(f"{artist_id}\t{depth}\t{popularity}\t{name}\n" for artist_id, depth, popularity, name in nodes))
+
+def _read_nodes(file:str):
+    """
+    The ids, depths, popularity and names in a nodes.tsv, and the size in bytes of its complete lines: reading stops at the partly written last line of an interrupted write.
+    """
+    ids, depths, popularity, names = list(), array("b"), array("b"), list()
+    size = 0
+    try:
+        with open(file, "rb") as f:
+            for line in f:
+                fields = line[:-1].decode("utf-8", "replace").split("\t", 3)
+                if not line.endswith(b"\n") or len(fields) < 4 or not fields[1].lstrip("-").isdigit() or not fields[2].lstrip("-").isdigit():
+                    break
+                ids.append(fields[0])
+                depths.append(int(fields[1]))
+                popularity.append(int(fields[2]))
+                names.append(fields[3])
+                size += len(line)
+    except FileNotFoundError:
+        pass
+    return ids, depths, popularity, names, size
+
+class ArtistCrawler(object):
+    """
+    Breadth-first crawl of the related-artist graph from seed artists, up to max_depth hops or max_nodes artists.
+    Related artists are fetched max_workers at a time and every artist is fetched once. With a directory the crawl is checkpointed there after every batch, and a new crawler on the same directory resumes it.
+    
+        crawler = ArtistCrawler(api, "graph", max_depth=2, max_nodes=20000)
+        graph = crawler.crawl(["0OdUWJ0sBjDrqHygGUXeCF"])
+        graph.save("graph")
+    
+    Parameters:
+    
+        - api: Api used to fetch the artists.
+        - directory: Checkpoint directory, None to crawl in memory only.
+        - max_depth: Hops from the seeds past which artists are not expanded.
+        - max_nodes: Artists the graph can hold, related artists found once it is full are left out.
+        - max_workers: Requests at once. Default: api.max_workers.
+        - batch_size: Artists fetched between two checkpoints.
+    """
+    def __init__(self, api, directory:str=None, max_depth:int=2, max_nodes:int=10000, max_workers:int=None, batch_size:int=256):
+        self.api = api
+        self.directory = directory
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_workers = max_workers or api.max_workers
+        self.batch_size = batch_size
+        self.ids, self.depths, self.popularity, self.names = list(), array("b"), array("b"), list()
+        self.sources = array("i") #crawled artists, in crawl order
+        self.offsets = array("q", [0]) #their related artists are targets[offsets[k]:offsets[k + 1]]
+        self.targets = array("i")
+        self.crawled = set()
+        self.requests = 0
+        self.failed = 0
+        if directory is not None:
+            makedirs(directory, exist_ok=True)
+            self._resume()
+        self.index = {artist_id:node for node, artist_id in enumerate(self.ids)}
+
+    def _resume(self):
+        """
+        Load the checkpoint files and cut them back to their last complete line and record, so the next checkpoint appends after whole records only.
+        """
+        nodes_loc, edges_loc = path.join(self.directory, "nodes.tsv"), path.join(self.directory, "edges.i32")
+        self.ids, self.depths, self.popularity, self.names, nodes_size = _read_nodes(nodes_loc)
+        records = array("i")
+        try:
+            with open(edges_loc, "rb") as f:
+                data = f.read()
+            records.frombytes(data[:len(data) - len(data) % 4])
+        except FileNotFoundError:
+            pass
+        if sys.byteorder != "little":
+            records.byteswap()
+        position = 0
+        while position + 2 <= len(records) and 0 <= records[position + 1] and position + 2 + records[position + 1] <= len(records): #a partly written last record is dropped
+            source, count = records[position], records[position + 1]
+            targets = records[position + 2:position + 2 + count]
+            if not 0 <= source < len(self.ids) or any(not 0 <= target < len(self.ids) for target in targets): #refers to artists lost with the last line of nodes.tsv
+                break
+            self._add_edges(source, targets)
+            position += 2 + count
+        for loc, size in ((nodes_loc, nodes_size), (edges_loc, position * 4)):
+            with open(loc, "ab") as f:
+                f.truncate(size)
+
+    def _add_edges(self, source:int, targets):
+        self.sources.append(source)
+        self.targets.extend(targets)
+        self.offsets.append(len(self.targets))
+        self.crawled.add(source)
+
+    def _add_node(self, artist:dict, depth:int):
+        node = self.index.get(artist["id"])
+        if node is not None or len(self.ids) >= self.max_nodes:
+            return node
+        node = self.index[artist["id"]] = len(self.ids)
+        self.ids.append(artist["id"])
+        self.depths.append(min(depth, 127))
+        popularity = artist.get("popularity")
+        self.popularity.append(-1 if popularity is None else popularity)
+        self.names.append((artist.get("name") or "").replace("\t", " ").replace("\n", " "))
+        return node
+
+    def _fetch(self, node:int):
+        response = self.api.get_artist_related_artists(self.ids[node])
+        if response.status_code == 404:
+            return list()
+        if response.status_code != 200:
+            raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+        return response.json()["artists"]
+
+    def frontier(self):
+        """
+        Artists found but not fetched yet, nearest to the seeds first.
+        """
+        return sorted((node for node in range(len(self.ids)) if node not in self.crawled and self.depths[node] < self.max_depth), key=lambda node: self.depths[node])
+
+    def crawl(self, seed_ids:list=None):
+        """
+        Crawl from seed_ids (added to those of a resumed crawl) until the frontier is empty, then return the graph.
+        Artists whose request fails are left in the frontier, counted in failed, and fetched again by the next crawl.
+        """
+        new_seeds = [artist_id for artist_id in dict.fromkeys(seed_ids or []) if artist_id not in self.index]
+        if new_seeds:
+            artists = self.api.get_artists_bulk(new_seeds)
+            start = len(self.ids)
+            for artist_id, artist in zip(new_seeds, artists):
+                self._add_node(artist or {"id":artist_id}, 0)
+            self._checkpoint(start, len(self.sources))
+        frontier = deque(self.frontier())
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while frontier:
+                batch = [frontier.popleft() for _ in range(min(self.batch_size, len(frontier)))]
+                nodes_start, edges_start = len(self.ids), len(self.sources)
+                futures = [executor.submit(self._fetch, node) for node in batch]
+                for node, future in zip(batch, futures):
+                    self.requests += 1
+                    try:
+                        related = future.result()
+                    except Exception:
+                        self.failed += 1
+                        continue
+                    known = len(self.ids)
+                    depth = self.depths[node] + 1
+                    self._add_edges(node, [target for target in (self._add_node(artist, depth) for artist in related) if target is not None])
+                    if depth < self.max_depth:
+                        frontier.extend(range(known, len(self.ids))) #artists new to the graph, each added once
+                self._checkpoint(nodes_start, edges_start)
+        return self.graph()
+
+    def _checkpoint(self, nodes_start:int, edges_start:int):
+        """
+        Append the artists from nodes_start and the related lists from edges_start to the checkpoint files, artists first so every edge record refers to saved artists.
+        """
+        if self.directory is None:
+            return
+        _write_nodes(path.join(self.directory, "nodes.tsv"), "a", zip(self.ids[nodes_start:], self.depths[nodes_start:], self.popularity[nodes_start:], self.names[nodes_start:]))
+        records = array("i")
+        for k in range(edges_start, len(self.sources)):
+            records.extend((self.sources[k], self.offsets[k + 1] - self.offsets[k]))
+            records.extend(self.targets[self.offsets[k]:self.offsets[k + 1]])
+        if sys.byteorder != "little":
+            records.byteswap()
+        with open(path.join(self.directory, "edges.i32"), "ab") as f:
+            records.tofile(f)
+
+    def graph(self):
+        """
+        The crawled graph as an ArtistGraph, artists that were not expanded have no related artists.
+        """
+        counts = array("q", [0] * (len(self.ids) + 1))
+        for k, source in enumerate(self.sources):
+            counts[source + 1] = self.offsets[k + 1] - self.offsets[k]
+        for node in range(len(self.ids)):
+            counts[node + 1] += counts[node]
+        indices = array("i", [0] * counts[-1])
+        for k, source in enumerate(self.sources):
+            indices[counts[source]:counts[source + 1]] = self.targets[self.offsets[k]:self.offsets[k + 1]]
+        return ArtistGraph(list(self.ids), counts, indices, array("b", self.depths), array("b", self.popularity), list(self.names))
+
+    def stats(self):
+        return {"nodes":len(self.ids), "crawled":len(self.crawled), "edges":len(self.targets), "requests":self.requests, "failed":self.failed}
+
+class LibraryExporter(object):
+    """
+    Streams the saved albums, tracks or shows of the current user to <type_of>.ndjson in directory, one saved object per line, enriched in batches through the multi-ID endpoints:
+    tracks get their "audio_features" and the full objects of their "artists", albums the full objects of their "artists".
+    With columnar, the flat fields in columns[type_of] are also appended to one file per column under directory/columns: <name>.f32 (raw little-endian float32, NaN where missing) or <name>.txt (one value per line).
+    After every batch the item count and the size of every output file are saved to checkpoint.json, an interrupted export run again with the same type_of, enrich and columnar resumes from there (files are cut back to the checkpoint first), with other settings it raises.
+    Saved items are listed newest first, so items saved or removed between two runs shift what a resumed export picks up.
+    
+        LibraryExporter(api, "export").run() #export/tracks.ndjson
+    
+    Parameters:
+    
+        - api: Api of the user, authorized with user-library-read.
+        - directory: Output directory, created if missing.
+        - type_of: albums, tracks or shows
+        - enrich: Enrichments to add, out of "audio_features" and "artists". Default: all that apply to type_of.
+        - columnar: Also write the columns.
+        - batch_size: Items enriched, written and checkpointed at once.
+        - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+    """
+    columns = {"tracks":{"id":("track", "id"), "name":("track", "name"), "added_at":("added_at",), "album_id":("track", "album", "id"), "duration_ms":("track", "duration_ms"),
+                         "popularity":("track", "popularity"), "explicit":("track", "explicit"), **{column:("audio_features", column) for column in AudioFeatureStore.columns if column != "duration_ms"}},
+               "albums":{"id":("album", "id"), "name":("album", "name"), "added_at":("added_at",), "release_date":("album", "release_date"), "total_tracks":("album", "total_tracks"),
+                         "popularity":("album", "popularity"), "label":("album", "label")},
+               "shows":{"id":("show", "id"), "name":("show", "name"), "added_at":("added_at",), "publisher":("show", "publisher"), "total_episodes":("show", "total_episodes")}}
+    text_columns = {"id", "name", "added_at", "album_id", "release_date", "label", "publisher"}
+
+    def __init__(self, api, directory:str, type_of:str="tracks", enrich:tuple=None, columnar:bool=False, batch_size:int=200, market:str=None):
+        if type_of not in ("albums", "tracks", "shows"):
+            raise Exception(f"{type_of} is not a valid type")
+        self.api = api
+        self.directory = directory
+        self.type_of = type_of
+        self.kind = type_of[:-1]
+        applicable = {"tracks":("audio_features", "artists"), "albums":("artists",), "shows":()}[type_of]
+        self.enrich = applicable if enrich is None else tuple(enrichment for enrichment in enrich if enrichment in applicable)
+        self.columnar = columnar
+        self.batch_size = batch_size
+        self.market = market
+        self.checkpoint_loc = path.join(directory, "checkpoint.json")
+        self.files = {"items":path.join(directory, f"{type_of}.ndjson")}
+        if columnar:
+            makedirs(path.join(directory, "columns"), exist_ok=True)
+            for column in self.columns[type_of]:
+                self.files[column] = path.join(directory, "columns", f"{column}.txt" if column in self.text_columns else f"{column}.f32")
+        makedirs(directory, exist_ok=True)
+        self.exported = 0
+
+    def _restore(self):
+        """
+        Cut every output file back to its size at the last checkpoint, return the number of items exported until then.
+        """
+        try:
+            with open(self.checkpoint_loc, "r") as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+        except FileNotFoundError:
+            checkpoint = {"exported":0, "sizes":{}}
+        for name, value in self._settings().items(): #other settings write other files, resuming with them would misalign the columns
+            if checkpoint.get(name, value) != value:
+                raise Exception(f"{self.directory} holds an export with {name} {checkpoint[name]}, not {value}")
+        for name, file in self.files.items():
+            with open(file, "ab") as output:
+                output.truncate(checkpoint["sizes"].get(name, 0))
+        return checkpoint["exported"]
+
+    def _settings(self):
+        return {"type_of":self.type_of, "columnar":self.columnar, "enrich":list(self.enrich)}
+
+    def _checkpoint(self):
+        checkpoint = {**self._settings(), "exported":self.exported, "sizes":{name:path.getsize(file) for name, file in self.files.items()}}
+        _atomic_write(self.checkpoint_loc, json.dumps(checkpoint), ".checkpoint")
+
+    def _enrich(self, batch:list):
+        items = [saved[self.kind] for saved in batch]
+        if "audio_features" in self.enrich:
+            track_ids = [item["id"] for item in items if item.get("id")]
+            features = dict(zip(track_ids, self.api.get_audio_features_bulk(track_ids)))
+            for saved, item in zip(batch, items):
+                saved["audio_features"] = features.get(item.get("id"))
+        if "artists" in self.enrich:
+            artist_ids = list(dict.fromkeys(artist["id"] for item in items for artist in item.get("artists", [])))
+            artists = dict(zip(artist_ids, self.api.get_artists_bulk(artist_ids)))
+            for saved, item in zip(batch, items):
+                saved["artists"] = [artists.get(artist["id"]) for artist in item.get("artists", [])]
+
+    def _value(self, saved:dict, keys:tuple):
+        for key in keys:
+            if not isinstance(saved, dict):
+                return None
+            saved = saved.get(key)
+        return saved
+
+    def _write(self, batch:list):
+        with open(self.files["items"], "a", encoding="utf-8") as output:
+            output.write("".join(json.dumps(saved, separators=(",", ":")) + "\n" for saved in batch))
+        if not self.columnar:
+            return
+        for column, keys in self.columns[self.type_of].items():
+            values = [self._value(saved, keys) for saved in batch]
+            if column in self.text_columns:
+                with open(self.files[column], "a", encoding="utf-8") as output:
+                    output.write("".join(("" if value is None else str(value).replace("\n", " ")) + "\n" for value in values))
+                continue
+            floats = array("f", (float("nan") if value is None else float(value) for value in values))
+            if sys.byteorder != "little":
+                floats.byteswap()
+            with open(self.files[column], "ab") as output:
+                floats.tofile(output)
+
+    def _flush(self, batch:list):
+        if self.enrich:
+            self._enrich(batch)
+        self._write(batch)
+        self.exported += len(batch)
+        self._checkpoint()
+
+    def run(self, read_ahead:int=4):
+        """
+        Export the library, resuming an interrupted export, and return the number of items exported in total.
+        Only batch_size items plus the pages read ahead are held at once.
+        """
+        self.exported = self._restore()
+        batch = list()
+        for saved in self.api.iter_user_saved(self.type_of, self.market, read_ahead, offset=self.exported):
+            batch.append(saved)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = list()
+        if batch:
+            self._flush(batch)
+        return self.exported
+
+class MutationQueue(object):
+    """
+    Write-behind queue of library and follow changes: calls return at once with one future per ID, and the changes are sent in batches of up to max_batch IDs
+    (one PUT or DELETE per type) once a batch is full or its oldest change has waited max_delay seconds.
+    Only the latest change of an ID is sent: saving, removing and saving again sends one save, and the futures of the replaced changes get the outcome of the one sent.
+    Futures resolve to True, or raise with the status of the failed request of their batch. Playlists are followed one per request, as the endpoint takes one playlist.
+    Playback queue items are not queued here, their order matters and they can not be batched.
+    
+        queue = MutationQueue(api)
+        futures = queue.save("tracks", track_ids)
+        queue.unsave("tracks", track_ids[:1])
+        queue.flush() #or queue.close() when done
+    
+    Parameters:
+    
+        - api: Api of the user the changes are made for.
+        - max_batch: IDs per request, at most 50.
+        - max_delay: Seconds a change can wait for its batch to fill up.
+    """
+    def __init__(self, api, max_batch:int=50, max_delay:float=1.0):
+        self.api = api
+        self.max_batch = min(max_batch, 50)
+        self.max_delay = max_delay
+        self.pending = OrderedDict() #(kind, type_of, id): [delete, futures, queued_at, public]
+        self.condition = Condition()
+        self.sending = Lock() #batches are sent by the worker or by flush, one at a time
+        self._thread = None
+        self._closed = False
+        self.submitted = 0
+        self.superseded = 0
+        self.requests = 0
+        self.failed = 0
+
+    def save(self, type_of:str, ids:list):
+        """
+        Save albums, tracks or shows to the library.
+        """
+        return self._submit("library", type_of, ids, False)
+
+    def unsave(self, type_of:str, ids:list):
+        return self._submit("library", type_of, ids, True)
+
+    def follow(self, type_of:str, ids:list):
+        """
+        Follow artists or users, type_of is artist or user.
+        """
+        return self._submit("follow", type_of, ids, False)
+
+    def unfollow(self, type_of:str, ids:list):
+        return self._submit("follow", type_of, ids, True)
+
+    def follow_playlist(self, playlist_id:str, public:str="true"):
+        return self._submit("playlist", None, [playlist_id], False, public)[0]
+
+    def unfollow_playlist(self, playlist_id:str):
+        return self._submit("playlist", None, [playlist_id], True)[0]
+
+    def _submit(self, kind:str, type_of:str, ids:list, delete:bool, public:str="true"):
+        if kind == "library" and type_of not in ("albums", "tracks", "shows") or kind == "follow" and type_of not in ("artist", "user"):
+            raise Exception(f"{type_of} is not a valid type")
+        futures = list()
+        with self.condition:
+            if self._closed:
+                raise Exception("The mutation queue is closed")
+            for entity_id in ids:
+                future = Future()
+                futures.append(future)
+                key = (kind, type_of, entity_id)
+                entry = self.pending.get(key)
+                if entry is None:
+                    self.pending[key] = [delete, [future], monotonic(), public]
+                else:
+                    self.superseded += entry[0] != delete
+                    entry[0], entry[3] = delete, public
+                    entry[1].append(future)
+            self.submitted += len(ids)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True, name="mutation-queue")
+                self._thread.start()
+            self.condition.notify()
+        return futures
+
+    def _take(self, force:bool):
+        """
+        Pop the batches that are due (all of them with force): a list of (kind, type_of, delete, public, entries) with entries (id, futures).
+        """
+        groups = defaultdict(list)
+        oldest = dict()
+        for key, entry in self.pending.items():
+            group = (key[0], key[1], entry[0], entry[3] if key[0] == "playlist" else None)
+            groups[group].append(key)
+            oldest[group] = min(oldest.get(group, entry[2]), entry[2])
+        batches = list()
+        now = monotonic()
+        for group, keys in groups.items():
+            size = 1 if group[0] == "playlist" else self.max_batch
+            due = force or now - oldest[group] >= self.max_delay
+            for start in range(0, len(keys), size):
+                chunk = keys[start:start + size]
+                if due or len(chunk) == size:
+                    batches.append((*group, [(key[2], self.pending.pop(key)[1]) for key in chunk]))
+        return batches
+
+    def _next_due(self):
+        if not self.pending:
+            return None
+        return max(0.0, min(entry[2] for entry in self.pending.values()) + self.max_delay - monotonic())
+
+    def _send(self, batch:tuple):
+        kind, type_of, delete, public, entries = batch
+        ids = [entity_id for entity_id, _ in entries]
+        try:
+            if kind == "library":
+                response = self.api.library(type_of, ids, delete)
+            elif kind == "follow":
+                response = self.api.follow(type_of, ids, delete)
+            else:
+                response = self.api.follow_playlist(ids[0], delete, public)
+            error = None if response.status_code < 300 else Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+        except Exception as exception:
+            error = exception
+        with self.condition:
+            self.requests += 1
+            self.failed += len(ids) if error is not None else 0
+        for _, futures in entries:
+            for future in futures:
+                if error is None:
+                    future.set_result(True)
+                else:
+                    future.set_exception(error)
+
+    def _run(self):
+        while True:
+            with self.sending: #taken before the batches are popped, so a flush can not send newer changes of the same IDs ahead of them
+                with self.condition:
+                    if self._closed:
+                        return
+                    batches = self._take(False)
+                    submitted = self.submitted
+                for batch in batches:
+                    self._send(batch)
+            if batches:
+                continue
+            with self.condition:
+                if not self._closed and self.submitted == submitted: #nothing came in since the batches were looked at
+                    self.condition.wait(self._next_due())
+
+    def flush(self):
+        """
+        Send every queued change now and wait for the outcome.
+        """
+        with self.sending:
+            with self.condition:
+                batches = self._take(True)
+            for batch in batches:
+                self._send(batch)
+
+    def close(self):
+        """
+        Flush, stop the worker and refuse new changes.
+        """
+        with self.condition:
+            self._closed = True
+            self.condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        """
+        IDs submitted, changes replaced by a later opposite one, changes waiting, requests sent and IDs whose request failed.
+        """
+        with self.condition:
+            return {"submitted":self.submitted, "superseded":self.superseded, "pending":len(self.pending), "requests":self.requests, "failed":self.failed}
+
+class PlaylistMirror(object):
+    """
+    Local SQLite copy of playlists and their tracks, kept up to date by snapshot_id: a refresh asks each playlist only for its snapshot_id
+    and pages through the tracks of the ones whose snapshot changed, so an unchanged playlist costs one small request per refresh.
+    
+        mirror = PlaylistMirror(api, "playlists.db")
+        mirror.add(playlist_ids)
+        mirror.refresh() #{"checked": ..., "changed": [...], ...}
+        mirror.tracks(playlist_ids[0])
+    
+    Parameters:
+    
+        - api: Api used to read the playlists.
+        - database: Path of the database file, created if missing.
+        - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+    """
+    def __init__(self, api, database:str, market:str=None):
+        self.api = api
+        self.market = market
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS playlists (id TEXT PRIMARY KEY, snapshot_id TEXT, total INTEGER, refreshed_at REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS playlist_tracks (playlist_id TEXT, position INTEGER, track_id TEXT, uri TEXT, added_at TEXT, PRIMARY KEY (playlist_id, position))")
+
+    def add(self, playlist_ids:list):
+        """
+        Mirror these playlists from the next refresh on.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO playlists (id) VALUES (?)", [(playlist_id,) for playlist_id in playlist_ids])
+
+    def remove(self, playlist_ids:list):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM playlist_tracks WHERE playlist_id = ?", [(playlist_id,) for playlist_id in playlist_ids])
+            self.connection.executemany("DELETE FROM playlists WHERE id = ?", [(playlist_id,) for playlist_id in playlist_ids])
+
+    def playlists(self):
+        """
+        {playlist ID: snapshot_id} of the mirrored playlists, snapshot_id is None until the first refresh.
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT id, snapshot_id FROM playlists"))
+
+    def tracks(self, playlist_id:str):
+        """
+        The (track_id, uri, added_at) of the tracks of a mirrored playlist, in playlist order.
+        """
+        with self.lock:
+            return self.connection.execute("SELECT track_id, uri, added_at FROM playlist_tracks WHERE playlist_id = ? ORDER BY position", (playlist_id,)).fetchall()
+
+    def _snapshot(self, playlist_id:str):
+        response = self.api.get_playlist(playlist_id, fields=["snapshot_id"])
+        if response.status_code != 200:
+            raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+        return response.json()["snapshot_id"]
+
+    def _download(self, playlist_id:str):
+        items = self.api.iter_playlist_tracks(playlist_id, fields=["total", "items(added_at,track(id,uri))"], market=self.market)
+        return [(playlist_id, position, (item.get("track") or {}).get("id"), (item.get("track") or {}).get("uri"), item.get("added_at")) for position, item in enumerate(items)]
+
+    def _store(self, playlist_id:str, snapshot_id:str, rows:list):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+            self.connection.executemany("INSERT INTO playlist_tracks (playlist_id, position, track_id, uri, added_at) VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.execute("UPDATE playlists SET snapshot_id = ?, total = ?, refreshed_at = ? WHERE id = ?", (snapshot_id, len(rows), time(), playlist_id))
+
+    def refresh(self, snapshots:dict=None, max_workers:int=None):
+        """
+        Bring the mirror up to date and report what it did: playlists checked, the IDs of the changed ones (re-paged), of those that failed, and the requests sent.
+        The snapshot read before paging is the one stored, so a playlist changed while it was being paged is paged again on the next refresh.
+        
+        Parameters:
+        
+            - snapshots: {playlist ID: snapshot_id} already known, e.g. from refresh_user_playlists, those playlists are not asked for theirs.
+            - max_workers: Playlists checked at once. Default: api.max_workers.
+        """
+        stored = self.playlists()
+        snapshots = snapshots or dict()
+        report = {"checked":len(stored), "changed":list(), "failed":list(), "requests":0}
+        def check(playlist_id):
+            snapshot_id = snapshots.get(playlist_id)
+            requests = 0
+            if snapshot_id is None:
+                snapshot_id, requests = self._snapshot(playlist_id), 1
+            if snapshot_id == stored[playlist_id]:
+                return playlist_id, snapshot_id, None, requests
+            rows = self._download(playlist_id)
+            return playlist_id, snapshot_id, rows, requests + max(1, -(-len(rows) // 100))
+        with ThreadPoolExecutor(max_workers=max_workers or self.api.max_workers) as executor:
+            futures = {executor.submit(check, playlist_id):playlist_id for playlist_id in stored}
+            for future in futures:
+                try:
+                    playlist_id, snapshot_id, rows, requests = future.result()
+                except Exception:
+                    report["failed"].append(futures[future])
+                    continue
+                report["requests"] += requests
+                if rows is not None:
+                    self._store(playlist_id, snapshot_id, rows)
+                    report["changed"].append(playlist_id)
+        return report
+
+    def refresh_user_playlists(self, user_id:str="current_user", max_workers:int=None):
+        """
+        Mirror every playlist of a user and refresh them, the snapshots come with the playlist list, 50 playlists per request, instead of one request per playlist.
+        """
+        snapshots = {playlist["id"]:playlist["snapshot_id"] for playlist in self.api.iter_playlist_list(user_id) if playlist}
+        self.add(list(snapshots))
+        report = self.refresh(snapshots, max_workers)
+        report["requests"] += max(1, -(-len(snapshots) // 50))
+        return report
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def lean_loads(content):
+    """
+    json.loads that leaves out the available_markets lists, the biggest part of most catalog objects, as the objects are decoded. The default decoder of Api.parse.
+    """
+    return json.loads(content, object_hook=_drop_markets)
+
+def _drop_markets(obj:dict):
+    obj.pop("available_markets", None)
+    return obj
+
+class Model(object):
+    """
+    Base of the response models: fields are copied from the decoded object into slots when the model is built, nested objects
+    (nested maps their name to (model, is_list)) are kept as they came and only turned into models on first access.
+    Keys in neither are not kept, so once its nested objects are accessed a model holds much less than the dict it came from.
+    The trade is memory for first-access time: reading a nested object the first time builds its model, several times slower than reading the dict would be.
+    """
+    __slots__ = ("_nested",)
+    fields = ()
+    nested = {}
+
+    def __init__(self, data:dict):
+        for field in self.fields:
+            setattr(self, field, data.get(field))
+        nested = {name:data[name] for name in self.nested if data.get(name) is not None}
+        self._nested = nested or None
+
+    def _decode(self, name:str, value):
+        model, is_list = self.nested[name]
+        if is_list:
+            return [model(element) if element is not None else None for element in value]
+        return model(value)
+
+    def __getattr__(self, name:str):
+        #only called for slots that are not set yet, i.e. nested objects on first access
+        if name not in type(self).nested:
+            raise AttributeError(f"{type(self).__name__} has no attribute {name}")
+        value = None
+        if self._nested and name in self._nested:
+            value = self._decode(name, self._nested.pop(name))
+        setattr(self, name, value)
+        return value
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{field}={getattr(self, field)!r}' for field in self.fields[:3])})"
+
+class Image(Model):
+    __slots__ = ("url", "height", "width")
+    fields = ("url", "height", "width")
+
+class Artist(Model):
+    __slots__ = ("id", "name", "uri", "popularity", "genres", "images")
+    fields = ("id", "name", "uri", "popularity", "genres")
+    nested = {"images":(Image, True)}
+
+class Album(Model):
+    __slots__ = ("id", "name", "uri", "album_type", "release_date", "total_tracks", "popularity", "label", "artists", "images", "tracks")
+    fields = ("id", "name", "uri", "album_type", "release_date", "total_tracks", "popularity", "label")
+    nested = {"artists":(Artist, True), "images":(Image, True), "tracks":(lambda page: Page(page, Track), False)}
+
+class Track(Model):
+    __slots__ = ("id", "name", "uri", "duration_ms", "explicit", "popularity", "track_number", "disc_number", "is_local", "preview_url", "album", "artists")
+    fields = ("id", "name", "uri", "duration_ms", "explicit", "popularity", "track_number", "disc_number", "is_local", "preview_url")
+    nested = {"album":(Album, False), "artists":(Artist, True)}
+
+class SavedTrack(Model):
+    """
+    Item of a playlist or of the saved tracks: the track with when it was added.
+    """
+    __slots__ = ("added_at", "is_local", "track")
+    fields = ("added_at", "is_local")
+    nested = {"track":(Track, False)}
+
+class Playlist(Model):
+    __slots__ = ("id", "name", "uri", "description", "public", "collaborative", "snapshot_id", "owner", "images", "tracks")
+    fields = ("id", "name", "uri", "description", "public", "collaborative", "snapshot_id")
+    nested = {"owner":(dict, False), "images":(Image, True), "tracks":(lambda page: Page(page, SavedTrack), False)}
+
+class Page(Model):
+    """
+    Paging object, items are turned into item_model objects on first access.
+    """
+    __slots__ = ("href", "limit", "offset", "total", "next", "previous", "items", "item_model")
+    fields = ("href", "limit", "offset", "total", "next", "previous")
+    nested = {"items":(None, True)}
+
+    def __init__(self, data:dict, item_model=dict):
+        self.item_model = item_model
+        super().__init__(data)
+
+    def _decode(self, name:str, value):
+        return [self.item_model(item) if item is not None else None for item in value]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+class SessionTransport(object):
+    """
+    Sends the requests of an Api through a requests Session, the default transport of Api.
+    A transport has send(method, url, params, data, headers) returning the response, and send_async doing the same for AsyncApi.
+    """
+    offline = False
+
+    def __init__(self, session:Session):
+        self.session = session
+
+    def send(self, method:str, url:str, params:dict=None, data:str=None, headers:dict=None):
+        return self.session.request(method, url, params=params, data=data, headers=headers)
+
+class AiohttpTransport(object):
+    """
+    Sends the requests of an AsyncApi through an aiohttp ClientSession, opened on the first request, the default transport of AsyncApi.
+    """
+    offline = False
+
+    def __init__(self, headers:dict, max_connections:int=100):
+        self.headers = headers
+        self.max_connections = max_connections
+        self.client = None
+
+    async def send_async(self, method:str, url:str, params:dict=None, data:str=None, headers:dict=None):
+        if self.client is None:
+            self.client = aiohttp.ClientSession(headers=self.headers, connector=aiohttp.TCPConnector(limit=self.max_connections))
+        async with self.client.request(method, url, params=params, data=data, headers=headers) as response:
+            return AsyncResponse(response.status, response.headers, await response.read(), str(response.url))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+class RecordingTransport(object):
+    """
+    Passes requests on to another transport and appends every exchange to a cassette: gzip compressed json lines of
+    method, url, params, data, status, the ETag/Retry-After/Content-Type headers, body and seconds taken. Authorization headers and token requests are never recorded.
+    Every exchange is written to disk as its own gzip member as soon as it is recorded, so a run that crashes or is killed keeps what it recorded.
+    
+        with RecordingTransport("run.jsonl.gz") as transport:
+            api = Api("credentials.json", transport=transport)
+    
+    Parameters:
+    
+        - cassette: Path of the cassette, appended to if it exists (after cutting off an exchange left half written by a killed run).
+        - inner: Transport the requests are sent through. Default: the default transport of the Api it is given to.
+    """
+    offline = False
+    kept_headers = ("Content-Type", "ETag", "Retry-After")
+
+    def __init__(self, cassette:str, inner=None):
+        self.inner = inner
+        self.lock = Lock()
+        self.file = open(cassette, "ab")
+        self.file.truncate(self._complete_size(cassette))
+        self.recorded = 0
+
+    @staticmethod
+    def _complete_size(cassette:str):
+        """
+        Size in bytes of the complete gzip members at the start of the cassette.
+        """
+        with open(cassette, "rb") as cassette_file:
+            data = cassette_file.read()
+        size = 0
+        while size < len(data):
+            member = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                member.decompress(data[size:])
+            except zlib.error:
+                break
+            if not member.eof:
+                break
+            size = len(data) - len(member.unused_data)
+        return size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _record(self, method:str, url:str, params:dict, data:str, response, elapsed:float):
+        line = json.dumps({"method":method.upper(), "url":url, "params":params or {}, "data":data, "status":response.status_code, "response_url":str(response.url),
+                           "headers":{name:response.headers[name] for name in self.kept_headers if name in response.headers},
+                           "body":response.content.decode("utf-8", "surrogateescape"), "elapsed":round(elapsed, 6)}, separators=(",", ":"))
+        member = gzip.compress((line + "\n").encode("utf-8"), compresslevel=6)
+        with self.lock:
+            self.file.write(member)
+            self.file.flush()
+            self.recorded += 1
+
+    def send(self, method:str, url:str, params:dict=None, data:str=None, headers:dict=None):
+        start = perf_counter()
+        response = self.inner.send(method, url, params, data, headers)
+        self._record(method, url, params, data, response, perf_counter() - start)
+        return response
+
+    async def send_async(self, method:str, url:str, params:dict=None, data:str=None, headers:dict=None):
+        start = perf_counter()
+        response = await self.inner.send_async(method, url, params, data, headers)
+        self._record(method, url, params, data, response, perf_counter() - start)
+        return response
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class ReplayTransport(object):
+    """
+    Answers requests from a cassette written by RecordingTransport, without network access: no request leaves the process and no token is asked for.
+    Requests are matched on method, url, params and data; repeated requests get the recorded responses in order, then the last one again.
+    A request that is not in the cassette raises.
     
-    def get_token(self, scope:str=None):
-        url = "https://accounts.spotify.com/api/token"
-        header = b64encode((self.client_id + ':' + self.client_secret).encode("ascii")).decode('ascii')
-        if not self.tokens: 
-            token = self.get_new_token(scope, False)
-            self.tokens = token
-            json.dump(token, open("tokens.json", "w"))
-        elif self.tokens["expires_at"] - time() < 60 or str(scope) not in self.tokens["scope"]: #Refresh scope #WARNING if first token has no token then refresh will not work.
-            token = self.get_new_token(scope, True)
-            token["expires_at"] = time() + token["expires_in"]
-            self.tokens = token
-        if "refresh_token" in list(self.tokens):
-            json.dump(self.tokens, open(self.tokens_loc, "w"))
-        token = self.tokens
-        return token              
-        
+        api = Api("credentials.json", transport=ReplayTransport("run.jsonl.gz", latency=1.0))
+    
+    Parameters:
+    
+        - cassette: Path of the cassette.
+        - latency: Fraction of the recorded time each response is delayed by, 0 to answer at once (CPU and memory profiling), 1 for the recorded latency.
+    """
+    offline = True
+
+    def __init__(self, cassette:str, latency:float=0.0):
+        self.latency = latency
+        self.lock = Lock()
+        self.exchanges = defaultdict(deque)
+        with gzip.open(cassette, "rt", encoding="utf-8") as cassette_file:
+            try:
+                for line in cassette_file:
+                    if not line.endswith("\n"): #cut short
+                        break
+                    if not line.strip():
+                        continue
+                    exchange = json.loads(line)
+                    self.exchanges[self.key(exchange["method"], exchange["url"], exchange["params"], exchange["data"])].append(exchange)
+            except EOFError: #the last exchange of a killed recording
+                pass
+        self.replayed = 0
+
+    @staticmethod
+    def key(method:str, url:str, params:dict, data:str):
+        return (method.upper(), url, tuple(sorted((str(name), str(value)) for name, value in (params or {}).items())), data or None)
+
+    def _next(self, method:str, url:str, params:dict, data:str):
+        with self.lock:
+            recorded = self.exchanges.get(self.key(method, url, params, data))
+            if not recorded:
+                raise Exception(f"{method} {url} {params or ''} is not in the cassette")
+            exchange = recorded.popleft() if len(recorded) > 1 else recorded[0]
+            self.replayed += 1
+        return exchange, exchange["body"].encode("utf-8", "surrogateescape")
+
+    def send(self, method:str, url:str, params:dict=None, data:str=None, headers:dict=None):
+        exchange, content = self._next(method, url, params, data)
+        if self.latency:
+            sleep(exchange["elapsed"] * self.latency)
+        return Api._response(exchange["status"], exchange["headers"], content, exchange["response_url"])
+
+    async def send_async(self, method:str, url:str, params:dict=None, data:str=None, headers:dict=None):
+        exchange, content = self._next(method, url, params, data)
+        if self.latency:
+            await asyncio.sleep(exchange["elapsed"] * self.latency)
+        return AsyncResponse(exchange["status"], CaseInsensitiveDict(exchange["headers"]), content, exchange["response_url"])
+
 class Api(object):
-    def __init__(self, auth_credentials:dict, tokens_loc:str = None):
+    def __init__(self, auth_credentials:dict, tokens_loc:str = None, max_workers:int = 8, scheduler:RequestScheduler = None, cache:ResponseCache = None, entity_cache:EntityCache = None, instrumentation:Instrumentation = None, session:Session = None, auth:Auth = None, transport = None, search_cache:ResponseCache = None):
         self.base_url = "https://api.spotify.com/v1/"
-        self.session = Session()
-        self.session.headers.update({"Accept": "application/json", "Content-Type": "application/json"})
-        self.auth = Auth(auth_credentials, tokens_loc)
+        self.max_workers = max_workers
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        self.cache = cache
+        self.entity_cache = entity_cache
+        self.instrumentation = instrumentation
+        self.decoder = lean_loads #used by parse, can be swapped for a faster one like orjson.loads
+        self.coalesce = True #identical GETs sent at the same time share one request
+        self.inflight = dict()
+        self.inflight_lock = Lock()
+        self.coalesced = 0 #requests saved by coalescing
+        self.search_cache = search_cache #search results by normalized query, e.g. ResponseCache(max_bytes=16 * 2 ** 20, ttl=3600)
+        self.search_hits = 0
+        self.session = session if session is not None else self.new_session(max_workers) #a given session (shared by a ClientPool) is used as is
+        self._own_session = session is None
+        self.auth = auth if auth is not None else Auth(auth_credentials, tokens_loc, session=self.session)
+        self.transport = self._transport(transport, SessionTransport(self.session))
+
+    @staticmethod
+    def _transport(transport, default):
+        """
+        The transport requests are sent through: default when transport is None, and default is what a RecordingTransport without an inner transport records.
+        """
+        if transport is None:
+            return default
+        if isinstance(transport, RecordingTransport) and transport.inner is None:
+            transport.inner = default
+        return transport
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Close the cassette of a RecordingTransport and the session, unless the session was given, as it may be shared with other clients.
+        """
+        transport = self.transport
+        while transport is not None:
+            if isinstance(transport, RecordingTransport):
+                transport.close()
+            transport = getattr(transport, "inner", None)
+        if self._own_session:
+            self.session.close()
+
+    def _authorization(self, scope):
+        """
+        The Authorization header for scope, and whether a token had to be requested for it.
+        """
+        if self.transport.offline: #replayed responses need no token, and there may be no network to get one
+            return "Bearer offline", False
+        token, requested = self.auth.fetch_token(scope)
+        return f'{token["token_type"]} {token["access_token"]}', requested
+
+    @staticmethod
+    def new_session(max_connections:int):
+        session = Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+        session.headers.update({"Accept": "application/json", "Content-Type": "application/json"})
+        return session
             
+    def parse(self, response, model, key:str=None):
+        """
+        Decode the body of a response with self.decoder into model objects.
+        
+        Parameters:
+        
+            - response: A response of this Api (awaited first with AsyncApi).
+            - model: The model to build, e.g. Track, or Page (for Page of a given item model use lambda data: Page(data, Track)).
+            - key: The field of the body the object (or list of objects) is in, e.g. "tracks" for get_tracks.
+        """
+        if response.status_code != 200:
+            raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+        body = self.decoder(response.content)
+        if key is not None:
+            body = body[key]
+        if type(body) is list:
+            return [model(item) if item is not None else None for item in body]
+        return model(body)
+
     @staticmethod
     def _parse_params(kwargs:dict):
         new = dict()
@@ -93,13 +2344,225 @@ class Api(object):
     
     @staticmethod
     def _id_to_uri(ids:list, id_type:str):
-        return [f"spotify:{id_type}:{i_id}" for i_id in ids]
+        return [i_id if i_id.startswith("spotify:") else f"spotify:{id_type}:{i_id}" for i_id in ids]
     
+    @staticmethod
+    def _response(status_code:int, headers:dict, content:bytes, url:str):
+        response = Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        response.encoding = "utf-8"
+        response.url = url
+        return response
+
+    @staticmethod
+    def _then(response, parse):
+        """
+        Apply parse to the response of _request, AsyncApi does it once the response is awaited.
+        """
+        return parse(response)
+
+    def _cache_lookup(self, request_type, url:str, scope, params):
+        """
+        Return (key, cached) for a request: key is None when the request is not cacheable, cached is the cache entry (etag, content, fresh) if there is one.
+        """
+        if self.cache is None or request_type != "GET":
+            return None, None
+        ttl = self.cache.ttl_for(url)
+        if ttl is None:
+            return None, None
+        key = self.cache.key(self.auth.user if scope else None, url, params)
+        return key, self.cache.lookup(key, ttl)
+
+    def _cache_store(self, key:str, cached:tuple, response):
+        if response.status_code == 304 and cached is not None:
+            self.cache.revalidated(key, cached[0], cached[1])
+            return self._response(200, {"Content-Type":"application/json", "ETag":cached[0]}, cached[1], response.url)
+        if response.status_code == 200:
+            self.cache.store(key, response.headers.get("ETag"), response.content)
+        return response
+
+    def _coalesce_key(self, request_type, url:str, scope, params):
+        """
+        Key under which identical requests share one in-flight request, None for requests that are never coalesced (anything but GET).
+        Requests made with the user token and with the client token never share one, as their responses can differ.
+        """
+        if not self.coalesce or request_type != "GET":
+            return None
+        if url == "search": #searches that only differ in case and whitespace get the same results
+            params = dict(params, q=self.normalize_query(params["q"]))
+        return ResponseCache.key(self.auth.user if scope else None, url, params)
+
     def _request(self, request_type, url:str, scope=None, params=None, data=None):
         params = self._parse_params(params) if params else None
         data = json.dumps(data) if data else None
-        token = self.auth.get_token(scope)
-        return self.session.request(request_type, self.base_url + url, params=params, data=data, headers={'Authorization': f'{token["token_type"]} {token["access_token"]}'})
+        key = self._coalesce_key(request_type, url, scope, params)
+        if key is None:
+            return self._cached_request(request_type, url, scope, params, data)
+        with self.inflight_lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            response = self._cached_request(request_type, url, scope, params, data)
+        except BaseException as error:
+            with self.inflight_lock:
+                del self.inflight[key]
+            future.set_exception(error)
+            raise
+        with self.inflight_lock:
+            del self.inflight[key]
+        future.set_result(response)
+        return response
+
+    def _cached_request(self, request_type, url:str, scope=None, params=None, data=None):
+        key, cached = self._cache_lookup(request_type, url, scope, params)
+        if key is None:
+            return self._send(request_type, url, scope, params, data)
+        if cached is not None and cached[2]:
+            return self._response(200, {"Content-Type":"application/json", "ETag":cached[0]}, cached[1], self.base_url + url)
+        response = self._send(request_type, url, scope, params, data, {"If-None-Match":cached[0]} if cached is not None and cached[0] else None)
+        return self._cache_store(key, cached, response)
+
+    def _send(self, request_type, url:str, scope=None, params=None, data=None, headers:dict=None):
+        instrumentation = self.instrumentation
+        attempt = 0
+        while True:
+            self.scheduler.wait()
+            if instrumentation is None:
+                authorization, _ = self._authorization(scope)
+                response = self.transport.send(request_type, self.base_url + url, params, data, dict(headers or {}, Authorization=authorization))
+            else:
+                start = perf_counter()
+                authorization, requested = self._authorization(scope)
+                instrumentation.record_token(perf_counter() - start, requested)
+                endpoint, start = instrumentation.before(request_type, url, params), perf_counter()
+                try:
+                    response = self.transport.send(request_type, self.base_url + url, params, data, dict(headers or {}, Authorization=authorization))
+                except Exception:
+                    instrumentation.record_request(request_type, endpoint, 0, perf_counter() - start, 0)
+                    raise
+                instrumentation.record_request(request_type, endpoint, response.status_code, perf_counter() - start, len(response.content))
+            delay = self.scheduler.retry_delay(request_type, response, attempt)
+            if delay is None:
+                return response
+            sleep(delay)
+            attempt += 1
+
+    def _entity_lookup(self, type_of:str, ids:list, params:dict=None):
+        """
+        Return (found, missing): the objects of ids in the entity cache by ID and the (unique) IDs that have to be requested.
+        found is None when the entity cache does not apply, market dependent requests are never served from it.
+        """
+        if self.entity_cache is None or type_of is None or (params or {}).get("market"):
+            return None, ids
+        found = dict()
+        for entity_id in ids:
+            if entity_id not in found:
+                entity = self.entity_cache.get(type_of, entity_id)
+                if entity is not None:
+                    found[entity_id] = entity
+        return found, list(dict.fromkeys(entity_id for entity_id in ids if entity_id not in found))
+
+    def _harvest(self, response, *nested):
+        """
+        Put the full objects a response carries into the entity cache and return the response, for _then.
+        Every (type_of, keys, field) of nested names a list in the body (at keys) and the objects in it (its items, or their field).
+        """
+        if self.entity_cache is None or response.status_code != 200:
+            return response
+        body = response.json()
+        for type_of, keys, field in nested:
+            found = body
+            for key in keys:
+                found = found.get(key) if isinstance(found, dict) else None
+            self.entity_cache.harvest(type_of, (item.get(field) if field and isinstance(item, dict) else item for item in found or ()))
+        return response
+
+    def _entity_merge(self, type_of:str, ids:list, found:dict, missing:list, fetched:list):
+        for entity_id, entity in zip(missing, fetched):
+            if entity is not None:
+                self.entity_cache.put(type_of, entity)
+                found[entity_id] = entity
+        return [found.get(entity_id) for entity_id in ids]
+
+    def _get_entities(self, url:str, ids:list, key:str, type_of:str, scope=None, params:dict=None):
+        """
+        Request the objects of ids from a multi-ID endpoint, only the ones missing from the entity cache go to the network.
+        The response is rebuilt locally, in the order of ids, when part of it came from the cache.
+        """
+        found, missing = self._entity_lookup(type_of, ids, params)
+        if found is not None and not missing:
+            return self._response(200, {"Content-Type":"application/json"}, json.dumps({key:[found[entity_id] for entity_id in ids]}).encode(), self.base_url + url)
+        response = self._request("GET", url, scope, params=dict(params or {}, ids=missing))
+        if found is None or response.status_code != 200:
+            return response
+        merged = self._entity_merge(type_of, ids, found, missing, response.json()[key])
+        return self._response(200, response.headers, json.dumps({key:merged}).encode(), response.url)
+
+    def _fan_out(self, url:str, ids:list, chunk_size:int, key:str, scope=None, params:dict=None, type_of:str=None):
+        """
+        Split ids in chunks of at most chunk_size, request all chunks at the same time (at most max_workers at once) and merge the key list of every response in input order.
+        IDs found in the entity cache (for the given type_of) are not requested.
+        """
+        found, missing = self._entity_lookup(type_of, ids, params)
+        chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        def fetch(chunk):
+            response = self._request("GET", url, scope, params=dict(params or {}, ids=chunk))
+            if response.status_code != 200:
+                raise Exception(f"{url} failed with status {response.status_code}: {response.text}")
+            return response.json()[key]
+        fetched = list()
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+                fetched = [item for items in executor.map(fetch, chunks) for item in items]
+        return fetched if found is None else self._entity_merge(type_of, ids, found, missing, fetched)
+
+    def _iter_offset(self, fetch, key:str=None, limit:int=50, offset:int=0, read_ahead:int=4, end:int=None):
+        """
+        Yield the items of an offset paged endpoint, fetch(limit, offset) returns the response for one page and key is the field the paging object is nested in (if any).
+        Once the first page gives the total, the next read_ahead pages are requested at the same time, so at most read_ahead + 1 pages are held at once.
+        Pages start before end, for endpoints that refuse offsets past it.
+        """
+        def page(page_offset):
+            response = fetch(limit, page_offset)
+            if response.status_code != 200:
+                raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+            body = response.json()
+            return body[key] if key else body
+        first = page(offset)
+        yield from first["items"]
+        offsets = iter(range(offset + limit, min(first["total"], end) if end else first["total"], limit))
+        executor = ThreadPoolExecutor(max_workers=max(read_ahead, 1))
+        try:
+            window = deque(executor.submit(page, page_offset) for page_offset in islice(offsets, max(read_ahead, 1)))
+            while window:
+                items = window.popleft().result()["items"]
+                window.extend(executor.submit(page, page_offset) for page_offset in islice(offsets, 1))
+                yield from items
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _iter_cursor(self, fetch, key:str, limit:int=50):
+        """
+        Yield the items of a cursor paged endpoint, fetch(limit, after) returns the response for the page after the given cursor and key is the field the paging object is nested in.
+        """
+        after = None
+        while True:
+            response = fetch(limit, after)
+            if response.status_code != 200:
+                raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+            body = response.json()[key]
+            yield from body["items"]
+            after = (body.get("cursors") or {}).get("after")
+            if not after or not body.get("next"):
+                return
     
     #Albums
     def get_albums(self, album_ids:list, market:str = None):
@@ -111,7 +2574,19 @@ class Api(object):
             - album_id: The Spotify ID for the album.
             - market: An ISO 3166-1 alpha-2 country code or the string from_token. Provide this parameter if you want to apply Track Relinking.
         """
-        return self._request("GET", "albums", params={"ids":album_ids, "market":market})
+        return self._get_entities("albums", album_ids, "albums", "album", params={"market":market})
+
+    def get_albums_bulk(self, album_ids:list, market:str = None):
+        """
+        Get Spotify catalog information for any number of albums. The ids are requested in parallel chunks of 20.
+        Returns the list of album objects in the same order as album_ids (None for unknown ids).
+        
+        Parameters:
+        
+            - album_ids: The Spotify IDs for the albums.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token. Provide this parameter if you want to apply Track Relinking.
+        """
+        return self._fan_out("albums", album_ids, 20, "albums", params={"market":market}, type_of="album")
 
     def get_album_tracks(self, album_id:str, limit:int=20, offset:int=0, market:str=None):
         """
@@ -126,6 +2601,18 @@ class Api(object):
         """
         return self._request("GET", f"albums/{album_id}/tracks", params={"limit":limit, "offset":offset, "market":market})
 
+    def iter_album_tracks(self, album_id:str, market:str=None, read_ahead:int=4):
+        """
+        Iterate over all the tracks of an album, pages of 50 are fetched as the iteration goes.
+        
+        Parameters:
+        
+            - album_id: The Spotify ID for the album.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token. Provide this parameter if you want to apply Track Relinking.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_album_tracks(album_id, limit, offset, market), limit=50, read_ahead=read_ahead)
+
     #Artists
     def get_artists(self, artist_ids:list):
         """
@@ -135,7 +2622,18 @@ class Api(object):
            
             - artist_id: The Spotify ID for the album.
         """
-        return self._request("GET", "artists", params={"ids":artist_ids})
+        return self._get_entities("artists", artist_ids, "artists", "artist")
+
+    def get_artists_bulk(self, artist_ids:list):
+        """
+        Get Spotify catalog information for any number of artists. The ids are requested in parallel chunks of 50.
+        Returns the list of artist objects in the same order as artist_ids (None for unknown ids).
+        
+        Parameter:
+           
+            - artist_ids: The Spotify IDs for the artists.
+        """
+        return self._fan_out("artists", artist_ids, 50, "artists", type_of="artist")
     
     def get_artist_albums(self, artist_id:str, include_groups:list=None, country:str=None, limit:int=20, ofset:int=0):
         """
@@ -156,7 +2654,20 @@ class Api(object):
         if include_groups:
             if list(filter(lambda x: x not in ("album", "single", "appears_on", "compilation"), include_groups)):
                 raise Exception(f"{include_groups} is not a valid list of filters")
-        return self._request("GET", f"artists/{artist_id}/albums", params={"include_groups":include_groups, "country":country, "limit":limit, "ofset":ofset})
+        return self._request("GET", f"artists/{artist_id}/albums", params={"include_groups":include_groups, "country":country, "limit":limit, "offset":ofset})
+
+    def iter_artist_albums(self, artist_id:str, include_groups:list=None, country:str=None, read_ahead:int=4):
+        """
+        Iterate over all the albums of an artist, pages of 50 are fetched as the iteration goes.
+        
+        Parameters:
+            
+            - artist_id: The Spotify ID for the artist.
+            - include_groups: album, single, appears_on and/or compilation. If not supplied, all album types will be returned.
+            - country: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_artist_albums(artist_id, include_groups, country, limit, offset), limit=50, read_ahead=read_ahead)
     
     def get_artist_top_tracks(self, artist_id:str, country:str):
         """
@@ -167,7 +2678,7 @@ class Api(object):
             - artist_id: The Spotify ID for the album.
             - country: An ISO 3166-1 alpha-2 country code or the string from_token. Supply this parameter to limit the response to one particular geographical market.
         """
-        return self._request("GET", f"artists/{artist_id}/top-tracks", params={"country":country})
+        return self._then(self._request("GET", f"artists/{artist_id}/top-tracks", params={"country":country}), lambda response: self._harvest(response, ("track", ("tracks",), None)))
     
     def get_artist_related_artists(self, artist_id:str):
         """
@@ -177,7 +2688,7 @@ class Api(object):
             
             - artist_id: The Spotify ID for the album.
         """
-        return self._request("GET", f"artists/{artist_id}/related-artists")
+        return self._then(self._request("GET", f"artists/{artist_id}/related-artists"), lambda response: self._harvest(response, ("artist", ("artists",), None)))
     
     #Browse
     def get_categories(self, country:str=None, locale:str=None, limit:int=20, offset:int=0):
@@ -192,6 +2703,18 @@ class Api(object):
             - offset: The index of the first track to return. Default: 0 (the first object). Use with limit to get the next set of tracks.
         """
         return self._request("GET", "browse/categories", params={"country":country, "locale":locale, "limit":limit, "offset":offset})
+
+    def iter_categories(self, country:str=None, locale:str=None, read_ahead:int=4):
+        """
+        Iterate over all the browse categories, pages of 50 are fetched as the iteration goes.
+        
+        Parameters:
+            
+            - country: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - locale: The desired language, consisting of an ISO 639-1 language code and an ISO 3166-1 alpha-2 country code, joined by an underscore.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_categories(country, locale, limit, offset), "categories", limit=50, read_ahead=read_ahead)
     
     def get_category_playlists(self, category_id:str, country:str=None, limit:int=20, offset:int=0):
         """
@@ -263,6 +2786,18 @@ class Api(object):
             - market: An ISO 3166-1 alpha-2 country code or the string from_token. Provide this parameter if you want to apply Track Relinking.
         """
         return self._request("GET", "episodes", params={"ids":ids, "market":market})
+
+    def get_episodes_bulk(self, ids:list, market:str = None):
+        """
+        Get Spotify catalog information for any number of episodes. The ids are requested in parallel chunks of 50.
+        Returns the list of episode objects in the same order as ids (None for unknown ids).
+        
+        Parameters:
+        
+            - ids: The Spotify IDs for the episodes.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token. Provide this parameter if you want to apply Track Relinking.
+        """
+        return self._fan_out("episodes", ids, 50, "episodes", params={"market":market}, type_of="episode")
     
     #Follow
     def get_if_user_follows(self, type_of:str, ids:list):
@@ -328,9 +2863,20 @@ class Api(object):
             - limit: The maximum number of items to return. Default: 20. Minimum: 1. Maximum: 50.
             - after: The last ID retrieved from the previous request.
         """
-        if type_of not in ("artist"):
+        if type_of not in ("artist",):
             raise Exception(f"{type_of} is not a valid type")
-        return self._request("GET", "me/following", "user-follow-read", params={"type":type_of, "after":after})
+        response = self._request("GET", "me/following", "user-follow-read", params={"type":type_of, "limit":limit, "after":after})
+        return self._then(response, lambda response: self._harvest(response, ("artist", ("artists", "items"), None)))
+
+    def iter_user_followed(self, type_of:str="artist"):
+        """
+        Iterate over all the current user’s followed artists, following the after cursor page by page.
+        
+        Parameters:
+            
+            - type_of: The ID type: currently only artist is supported.
+        """
+        return self._iter_cursor(lambda limit, after: self.get_user_followed(type_of, limit, after), f"{type_of}s", limit=50)
     
     #Library
     def get_if_user_saved(self, type_of:str, ids:list):
@@ -359,7 +2905,21 @@ class Api(object):
         """
         if type_of not in ("albums", "tracks", "shows"):
             raise Exception(f"{type_of} is not a valid type")
-        return self._request("GET", f"me/{type_of}", "user-library-read", params={"limit":limit, "offset":offset, "market":market})
+        response = self._request("GET", f"me/{type_of}", "user-library-read", params={"limit":limit, "offset":offset, "market":market})
+        return self._then(response, lambda response: self._harvest(response, (type_of[:-1], ("items",), type_of[:-1]))) if type_of != "shows" else response
+
+    def iter_user_saved(self, type_of:str, market:str=None, read_ahead:int=4, offset:int=0):
+        """
+        Iterate over all the albums/tracks/shows saved in the current Spotify user’s ‘Your Music’ library, pages of 50 are fetched as the iteration goes.
+        
+        Parameters:
+        
+            - type of: albums, tracks or shows
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+            - offset: The index of the first object to return.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_user_saved(type_of, limit, offset, market), limit=50, offset=offset, read_ahead=read_ahead)
     
     def library(self, type_of:str, ids:list, delete:bool):
         """
@@ -371,10 +2931,10 @@ class Api(object):
             - ids: A comma-separated list of the Spotify IDs.
             - delete: True to remove, False to save.
         """
-        verb = "Delete" if delete else "PUT"
+        verb = "DELETE" if delete else "PUT"
         if type_of not in ("albums", "tracks", "shows"):
             raise Exception(f"{type_of} is not a valid type")
-        return self._request(verb, f"me/{type_of}", params={"ids":ids})
+        return self._request(verb, f"me/{type_of}", "user-library-modify", params={"ids":ids})
     
     #Personalization
     def get_user_top(self, type_of:str, limit:int=20, offset:int=0, time_range:str="medium_term"):
@@ -390,7 +2950,20 @@ class Api(object):
         """
         if type_of not in ("artists", "tracks"):
             raise Exception(f"{type_of} is not a valid type")
-        return self._request("GET", f"me/top/{type_of}", "user-top-read", params={"limit":limit, "offset":offset, "time_range":time_range})
+        response = self._request("GET", f"me/top/{type_of}", "user-top-read", params={"limit":limit, "offset":offset, "time_range":time_range})
+        return self._then(response, lambda response: self._harvest(response, (type_of[:-1], ("items",), None)))
+
+    def iter_user_top(self, type_of:str, time_range:str="medium_term", read_ahead:int=4):
+        """
+        Iterate over all the current user’s top artists or tracks, pages of 50 are fetched as the iteration goes.
+        
+        Parameters:
+        
+            - type of: The type of entity to return. Valid values: artists or tracks.
+            - time range: long_term, medium_term or short_term. Default: medium_term.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_user_top(type_of, limit, offset, time_range), limit=50, read_ahead=read_ahead)
     
     #Player
     def playback_add_queue_item(self, uri:str, device_id:str=None):
@@ -531,10 +3104,10 @@ class Api(object):
         Parameters:
         
             - playlist id: The Spotify ID for the playlist.
-            - track ids: list of track
+            - track ids: list of track IDs (or URIs). Maximum: 100.
             - position: The position to insert the tracks, a zero-based index. If omitted, the tracks will be appended to the playlist.
         """
-        return self._request("POST", f"playlists/{playlist_id}/tracks", "playlist-modify-private playlist-modify-public", params={"track_ids":self._id_to_uri(track_ids, "tracks"), "position":position})
+        return self._request("POST", f"playlists/{playlist_id}/tracks", "playlist-modify-private playlist-modify-public", params={"uris":self._id_to_uri(track_ids, "track"), "position":position})
     
     def playlist_details(self, playlist_id:str, name:str=None, public:str=None, collaborative:str=None, description:str=None):
         """
@@ -573,7 +3146,20 @@ class Api(object):
             - limit: The maximum number of playlists to return. Default: 20. Minimum: 1. Maximum: 50.
             - offset: The index of the first playlist to return. Default: 0 (the first object). Maximum offset: 100.000. Use with limit to get the next set of playlists.
         """
-        return self._request("GET", f"users/{user_id}/playlists", "playlist-read-private playlist-read-collaborative")
+        if user_id == "current_user":
+            user_id = self.auth.user
+        return self._request("GET", f"users/{user_id}/playlists", "playlist-read-private playlist-read-collaborative", params={"limit":limit, "offset":offset})
+
+    def iter_playlist_list(self, user_id:str, read_ahead:int=4):
+        """
+        Iterate over all the playlists owned or followed by a user, pages of 50 are fetched as the iteration goes.
+        
+        Parameters:
+        
+            - user_id: The user’s Spotify user ID. Use "current_user" for current user.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_playlist_list(user_id, limit, offset), limit=50, read_ahead=read_ahead)
  
     def get_playlist(self, playlist_id:str, fields:list=None, market:str=None):
         """
@@ -585,7 +3171,7 @@ class Api(object):
             - fields: ilters for the query: a comma-separated list of the fields to return. If omitted, all fields are returned. For example, to get just the playlist’s description and URI: fields=description,uri. A dot separator can be used to specify non-reoccurring fields, while parentheses can be used to specify reoccurring fields within objects. For example, to get just the added date and user ID of the adder: fields=tracks.items(added_at,added_by.id). Use multiple parentheses to drill down into nested objects, for example: fields=tracks.items(track(name,href,album(name,href))). Fields can be excluded by prefixing them with an exclamation mark, for example: fields=tracks.items(track(name,href,album(!name,href)))
             - market: An ISO 3166-1 alpha-2 country code or the string from_token.
         """
-        return self._request("GET", f"playlists/{playlist_id}", params={"fields":fields, "market":market})
+        return self._request("GET", f"playlists/{playlist_id}", "playlist-read-private playlist-read-collaborative", params={"fields":fields, "market":market})
     
     def get_playlist_cover_image(self, playlist_id:str):
         """
@@ -616,35 +3202,269 @@ class Api(object):
             - offset: The index of the first playlist to return. Default: 0 (the first object). Maximum offset: 100.000. Use with limit to get the next set of playlists.
             - market: An ISO 3166-1 alpha-2 country code or the string from_token.
         """
-        return self._request("GET", f"playlists/{playlist_id}/tracks", "playlist-read-private playlist-read-collaborative", params={"fields":fields, "limit":limit, "offset":offset, "market":market})
+        response = self._request("GET", f"playlists/{playlist_id}/tracks", "playlist-read-private playlist-read-collaborative", params={"fields":fields, "limit":limit, "offset":offset, "market":market})
+        return self._then(response, lambda response: self._harvest(response, ("track", ("items",), "track"))) if fields is None else response #filtered tracks are not full objects
+
+    def iter_playlist_tracks(self, playlist_id:str, fields:list=None, market:str=None, read_ahead:int=4):
+        """
+        Iterate over all the tracks of a playlist, pages of 100 are fetched as the iteration goes.
+        
+        Parameters
+        
+            - playlist_id: The Spotify ID for the playlist.
+            - fields: Filters for the query, see get_playlist_tracks. If given it has to keep the total and items fields, for example: ["total", "items(track(id,name))"].
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.get_playlist_tracks(playlist_id, fields, limit, offset, market), limit=100, read_ahead=read_ahead)
     
-    def playlist_remove_track(self, playlist_id:str, track_ids:list):
+    def playlist_remove_track(self, playlist_id:str, track_ids:list, snapshot_id:str=None):
         """
         Remove one or more tracks from a user’s playlist.
         
         Parameters:
         
             - playlist id: The Spotify ID for the playlist.
-            - track ids: list of track
+            - track ids: list of track IDs (or URIs), every occurrence is removed. Maximum: 100.
+            - snapshot_id: The playlist’s snapshot ID against which you want to make the changes.
         """
-        return self._request("DELETE", f"playlists/{playlist_id}/tracks", "playlist-modify-private playlist-modify-public", params={"track_ids":self._id_to_uri(track_ids, "tracks")})
+        data = {"tracks":[{"uri":uri} for uri in self._id_to_uri(track_ids, "track")]}
+        if snapshot_id:
+            data["snapshot_id"] = snapshot_id
+        return self._request("DELETE", f"playlists/{playlist_id}/tracks", "playlist-modify-private playlist-modify-public", data=data)
     
-    #Reorder,Replace,Custom Playlist Cover
+    #Reorder,Replace
+    def playlist_reorder_tracks(self, playlist_id:str, range_start:int, insert_before:int, range_length:int=1, snapshot_id:str=None):
+        """
+        Reorder a track or a group of tracks in a playlist.
+        
+        Parameters:
+        
+            - playlist_id: The Spotify ID for the playlist.
+            - range_start: The position of the first track to be reordered.
+            - insert_before: The position where the tracks should be inserted. To reorder the tracks to the end of the playlist, simply set insert_before to the position after the last track.
+            - range_length: The amount of tracks to be reordered. Default: 1.
+            - snapshot_id: The playlist’s snapshot ID against which you want to make the changes.
+        """
+        data = {"range_start":range_start, "insert_before":insert_before, "range_length":range_length}
+        if snapshot_id:
+            data["snapshot_id"] = snapshot_id
+        return self._request("PUT", f"playlists/{playlist_id}/tracks", "playlist-modify-private playlist-modify-public", data=data)
+
+    def playlist_replace_tracks(self, playlist_id:str, track_ids:list):
+        """
+        Replace all the tracks in a playlist, overwriting its existing tracks. This powerful request can be useful for replacing tracks, re-ordering existing tracks, or clearing the playlist.
+        
+        Parameters:
+        
+            - playlist_id: The Spotify ID for the playlist.
+            - track_ids: list of track IDs (or URIs). Maximum: 100.
+        """
+        return self._request("PUT", f"playlists/{playlist_id}/tracks", "playlist-modify-private playlist-modify-public", data={"uris":self._id_to_uri(track_ids, "track")})
+
+    @staticmethod
+    def _playlist_diff(current:list, desired:list):
+        """
+        Plan the requests that turn the playlist current into desired (both lists of URIs).
+        Surplus tracks are removed first, then missing ones appended, then blocks moved into place; if replacing the whole playlist takes fewer requests, that is the plan instead.
+        Returns a list of steps: ("remove", tracks), ("add", uris), ("reorder", range_start, insert_before, range_length) or ("replace", uris).
+        """
+        steps = list()
+        state = list(current)
+        wanted = Counter(desired)
+        have = Counter(state)
+        surplus = [(uri, have[uri] - wanted[uri]) for uri in have if have[uri] > wanted[uri]]
+        for start in range(0, len(surplus), 100):
+            positions = defaultdict(list)
+            for position, uri in enumerate(state):
+                positions[uri].append(position)
+            tracks = list()
+            dropped = set()
+            for uri, count in surplus[start:start + 100]:
+                if not wanted[uri]:
+                    tracks.append({"uri":uri})
+                    dropped.update(positions[uri])
+                else: #keep the first occurrences of a duplicated track
+                    tracks.append({"uri":uri, "positions":positions[uri][-count:]})
+                    dropped.update(positions[uri][-count:])
+            state = [uri for position, uri in enumerate(state) if position not in dropped]
+            steps.append(("remove", tracks))
+        missing = wanted - Counter(state)
+        added = list()
+        for uri in desired:
+            if missing[uri]:
+                missing[uri] -= 1
+                added.append(uri)
+        for start in range(0, len(added), 100):
+            steps.append(("add", added[start:start + 100]))
+        state += added
+        position = 0
+        while position < len(desired):
+            if state[position] == desired[position]:
+                position += 1
+                continue
+            source = state.index(desired[position], position + 1)
+            length = 1
+            while source + length < len(state) and state[source + length] == desired[position + length]:
+                length += 1
+            steps.append(("reorder", source, position, length))
+            state[position:position] = state[source:source + length]
+            del state[source + length:source + 2 * length]
+            position += length
+        replace = [("replace", desired[:100])] + [("add", desired[start:start + 100]) for start in range(100, len(desired), 100)]
+        return replace if len(replace) < len(steps) else steps
+
+    def _playlist_step(self, playlist_id:str, step:tuple, snapshot_id:str):
+        scope = "playlist-modify-private playlist-modify-public"
+        if step[0] == "remove":
+            return self._request("DELETE", f"playlists/{playlist_id}/tracks", scope, data={"tracks":step[1], "snapshot_id":snapshot_id})
+        if step[0] == "add":
+            return self._request("POST", f"playlists/{playlist_id}/tracks", scope, data={"uris":step[1]})
+        if step[0] == "reorder":
+            return self._request("PUT", f"playlists/{playlist_id}/tracks", scope, data={"range_start":step[1], "insert_before":step[2], "range_length":step[3], "snapshot_id":snapshot_id})
+        return self._request("PUT", f"playlists/{playlist_id}/tracks", scope, data={"uris":step[1]})
+
+    def sync_playlist(self, playlist_id:str, desired_ids:list):
+        """
+        Make a playlist contain exactly desired_ids, in that order, with as few requests as possible.
+        The current tracks are streamed, diffed against desired_ids and the diff is sent in batches of up to 100 tracks, each request chained on the snapshot_id of the previous one.
+        Returns a report: {"requests", "removed", "added", "moved", "replaced", "snapshot_id"}, where requests counts every request made, reads included.
+        
+        Parameters:
+        
+            - playlist_id: The Spotify ID for the playlist.
+            - desired_ids: The track IDs (or URIs) the playlist should have, in order.
+        """
+        snapshot_id = self._playlist_snapshot(self.get_playlist(playlist_id, fields=["snapshot_id"]))
+        current = [item["track"]["uri"] for item in self.iter_playlist_tracks(playlist_id, fields=["total", "items(track(uri))"]) if item.get("track")]
+        steps = self._playlist_diff(current, self._id_to_uri(desired_ids, "track"))
+        for step in steps:
+            snapshot_id = self._playlist_snapshot(self._playlist_step(playlist_id, step, snapshot_id))
+        return self._sync_report(steps, len(current), snapshot_id)
+
+    @staticmethod
+    def _playlist_snapshot(response):
+        if response.status_code not in (200, 201):
+            raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+        return response.json()["snapshot_id"]
+
+    @staticmethod
+    def _sync_report(steps:list, tracks:int, snapshot_id:str):
+        return {"requests":2 + max(tracks - 1, 0) // 100 + len(steps), "removed":sum(len(step[1]) for step in steps if step[0] == "remove"),
+                "added":sum(len(step[1]) for step in steps if step[0] in ("add", "replace")), "moved":sum(step[3] for step in steps if step[0] == "reorder"),
+                "replaced":any(step[0] == "replace" for step in steps), "snapshot_id":snapshot_id}
     
     #Search
+    search_types = ("album", "artist", "playlist", "track", "show", "episode")
+
+    @staticmethod
+    def normalize_query(query:str):
+        """
+        The query with its whitespace collapsed and everything but the operators (NOT, OR, AND, which are case-sensitive) lower cased,
+        the key under which searches are cached and coalesced: queries that only differ in those are searched once. The query is sent as given.
+        """
+        return " ".join(word if word in ("NOT", "OR", "AND") else word.lower() for word in query.split())
+
+    def search(self, query:str, types:list, limit:int=20, offset:int=0, market:str=None, include_external:str=None):
+        """
+        Get Spotify catalog information about albums, artists, playlists, tracks, shows or episodes that match a keyword string.
+        Results are kept in search_cache (if one was given) for its ttl, so repeated queries are answered locally.
+        
+        Parameters:
+        
+            - query: Search query keywords and optional field filters and operators, e.g. "roadhouse blues artist:doors".
+            - types: A list (or one) of album, artist, playlist, track, show and episode.
+            - limit: The maximum number of results to return in each item type. Default: 20. Minimum: 1. Maximum: 50.
+            - offset: The index of the first result to return. Default: 0. Maximum: 1000 (including limit).
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - include_external: audio to mark externally hosted audio content as playable.
+        """
+        types = sorted({types} if isinstance(types, str) else set(types))
+        invalid = [type_of for type_of in types if type_of not in self.search_types]
+        if invalid or not types:
+            raise Exception(f"{', '.join(invalid) or 'no type'} is not a valid search type")
+        if offset + limit > 1000:
+            raise Exception("Search results are only available up to offset 1000")
+        params = self._parse_params({"q":" ".join(query.split()), "type":types, "limit":limit, "offset":offset, "market":market, "include_external":include_external})
+        key = ResponseCache.key(None, "search", dict(params, q=self.normalize_query(query))) if self.search_cache is not None else None
+        cached = self.search_cache.lookup(key) if key is not None else None
+        if cached is not None and cached[2]:
+            self.search_hits += 1
+            return self._cached_search(self._response(200, {"Content-Type":"application/json"}, cached[1], self.base_url + "search"))
+        return self._then(self._request("GET", "search", params=params), lambda response: self._search_store(key, response))
+
+    @staticmethod
+    def _cached_search(response):
+        """
+        A search answered from search_cache, AsyncApi wraps it in a coroutine.
+        """
+        return response
+
+    def _search_store(self, key:str, response):
+        if key is not None and response.status_code == 200:
+            self.search_cache.store(key, None, response.content)
+        return self._harvest(response, ("track", ("tracks", "items"), None), ("artist", ("artists", "items"), None)) #found albums are simplified
+
+    def iter_search(self, query:str, type_of:str, market:str=None, include_external:str=None, read_ahead:int=4):
+        """
+        Iterate over the results of one type for a query, pages of 50 are fetched as the iteration goes, up to the 1000 results Spotify returns.
+        
+        Parameters:
+        
+            - query: Search query keywords and optional field filters and operators.
+            - type_of: album, artist, playlist, track, show or episode.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - include_external: audio to mark externally hosted audio content as playable.
+            - read_ahead: Number of pages requested ahead of the one being iterated.
+        """
+        return self._iter_offset(lambda limit, offset: self.search(query, type_of, limit, offset, market, include_external), f"{type_of}s", limit=50, read_ahead=read_ahead, end=1000)
+
+    def search_many(self, queries:list, types:list, limit:int=20, market:str=None, window:int=None):
+        """
+        Run many searches at the same time, yielding (query, response) in the order of queries.
+        At most window (default: 2 × max_workers) searches are in flight, and like every request they go through the scheduler, so its rate limit and 429 handling apply.
+        Identical normalized queries are sent once (through search_cache and coalescing).
+        
+        Parameters:
+        
+            - queries: The search queries, any iterable, consumed as the results are.
+            - types: A list (or one) of album, artist, playlist, track, show and episode.
+            - limit: The maximum number of results to return in each item type.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+            - window: Searches in flight at once.
+        """
+        window = window or 2 * self.max_workers
+        queries = iter(queries)
+        executor = ThreadPoolExecutor(max_workers=min(window, self.max_workers))
+        try:
+            pending = deque((query, executor.submit(self.search, query, types, limit, 0, market)) for query in islice(queries, window))
+            while pending:
+                query, future = pending.popleft()
+                pending.extend((next_query, executor.submit(self.search, next_query, types, limit, 0, market)) for next_query in islice(queries, 1))
+                yield query, future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
     
     #Shows
     
     #Tracks
-    def get_audio_analysis(self, track_id:str):
+    def get_audio_analysis(self, track_id:str, columnar:bool=False):
         """
         Get a detailed audio analysis for a single track identified by its unique Spotify ID.
         
         Parameters:
         
             - track id: The Spotify ID for the track.
+            - columnar: True to get an AudioAnalysis (numpy arrays) instead of the response.
         """
-        return self._request("GET", f"audio-analysis/{track_id}")
+        response = self._request("GET", f"audio-analysis/{track_id}")
+        return self._then(response, self._audio_analysis) if columnar else response
+
+    @staticmethod
+    def _audio_analysis(response):
+        if response.status_code != 200:
+            raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+        return AudioAnalysis.from_json(response.content)
     
     def get_audio_features(self, track_ids:list):
         """
@@ -654,7 +3474,18 @@ class Api(object):
 
             -track ids: A comma-separated list of the Spotify IDs for the tracks. Maximum: 100 IDs.
         """
-        return self._request("GET", "audio-features", params={"ids":track_ids})
+        return self._get_entities("audio-features", track_ids, "audio_features", "audio_features")
+
+    def get_audio_features_bulk(self, track_ids:list):
+        """
+        Get audio features for any number of tracks. The ids are requested in parallel chunks of 100.
+        Returns the list of audio features objects in the same order as track_ids (None for unknown ids).
+        
+        Parameters:
+
+            - track ids: The Spotify IDs for the tracks.
+        """
+        return self._fan_out("audio-features", track_ids, 100, "audio_features", type_of="audio_features")
     
     def get_tracks(self, track_ids:list, market=None):
         """
@@ -665,7 +3496,19 @@ class Api(object):
             - track ids: A comma-separated list of the Spotify IDs for the tracks. Maximum: 50 IDs.
             - market: An ISO 3166-1 alpha-2 country code or the string from_token.
         """
-        return self._request("GET", "traks", params={"ids":track_ids, "market":market})
+        return self._get_entities("tracks", track_ids, "tracks", "track", params={"market":market})
+
+    def get_tracks_bulk(self, track_ids:list, market=None):
+        """
+        Get Spotify catalog information for any number of tracks. The ids are requested in parallel chunks of 50.
+        Returns the list of track objects in the same order as track_ids (None for unknown ids).
+        
+        Parameters:
+        
+            - track ids: The Spotify IDs for the tracks.
+            - market: An ISO 3166-1 alpha-2 country code or the string from_token.
+        """
+        return self._fan_out("tracks", track_ids, 50, "tracks", params={"market":market}, type_of="track")
     
     #User Profile
     def get_user_profile(self, user_id:str):
@@ -678,4 +3521,305 @@ class Api(object):
         """
         return self._request("GET", "users", params={"user_id":user_id})
 
+class AsyncResponse(object):
+    """
+    Fully read response of an AsyncApi request, with the parts of requests.Response the callers use.
+    """
+    def __init__(self, status_code:int, headers, content:bytes, url:str):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncApi(Api):
+    """
+    Asyncio version of Api, built on aiohttp. It has the same methods as Api but each one returns a coroutine that resolves to an AsyncResponse,
+    the iter_* methods return async generators and the *_bulk methods coroutines that resolve to the merged list.
+    The Auth (and so the token) is shared with the synchronous code; coroutines that find the token expired wait on a single refresh.
+    Use it as an async context manager, or call close when done:
+    
+        async with AsyncApi("credentials.json") as api:
+            response = await api.get_artists(["0OdUWJ0sBjDrqHygGUXeCF"])
+    
+    Parameters:
+    
+        - auth_credentials: Path of the credentials file.
+        - tokens_loc: Path of the tokens file.
+        - max_connections: Maximum number of connections open at once. Requests over it wait for a free connection.
+        - scheduler: RequestScheduler deciding when requests are sent, can be shared with other clients.
+        - cache: ResponseCache for GET requests, None to not cache.
+        - entity_cache: EntityCache the multi-ID lookups are served from, None to not cache.
+        - instrumentation: Instrumentation recording the requests, None to not record them.
+        - transport: Transport the requests are sent through (with send_async), e.g. a RecordingTransport or ReplayTransport. Default: an AiohttpTransport.
+        - search_cache: ResponseCache of search results, None to not cache.
+    """
+    def __init__(self, auth_credentials:dict, tokens_loc:str = None, max_connections:int = 100, scheduler:RequestScheduler = None, cache:ResponseCache = None, entity_cache:EntityCache = None, instrumentation:Instrumentation = None, transport = None, search_cache:ResponseCache = None):
+        if aiohttp is None and not getattr(transport, "offline", False):
+            raise Exception("AsyncApi needs aiohttp, install it with: pip install aiohttp")
+        super().__init__(auth_credentials, tokens_loc, scheduler=scheduler, cache=cache, entity_cache=entity_cache, instrumentation=instrumentation, search_cache=search_cache)
+        self.max_connections = max_connections
+        self.transport = self._transport(transport, AiohttpTransport(dict(self.session.headers), max_connections))
+        self._token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        transport = self.transport
+        while transport is not None: #the aiohttp session may be wrapped in a RecordingTransport
+            if isinstance(transport, AiohttpTransport):
+                await transport.close()
+            elif isinstance(transport, RecordingTransport):
+                transport.close()
+            transport = getattr(transport, "inner", None)
+        self.session.close()
+
+    async def _get_token(self, scope=None):
+        """
+        A valid token for scope and whether it had to be requested, the token endpoint is called in a thread so the event loop keeps running.
+        """
+        token = self.auth.cached_token(scope)
+        if token is not None:
+            return token, False
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock: #the first coroutine refreshes, the others find a valid token once they get the lock
+            token = self.auth.cached_token(scope)
+            if token is not None:
+                return token, False
+            return await asyncio.get_running_loop().run_in_executor(None, self.auth.fetch_token, scope)
+
+    @staticmethod
+    def _response(status_code:int, headers:dict, content:bytes, url:str):
+        return AsyncResponse(status_code, CaseInsensitiveDict(headers), content, url)
+
+    @staticmethod
+    async def _then(response, parse):
+        return parse(await response)
+
+    @staticmethod
+    async def _cached_search(response):
+        return response
+
+    async def search_many(self, queries:list, types:list, limit:int=20, market:str=None, window:int=None):
+        window = window or 2 * self.max_connections
+        queries = iter(queries)
+        pending = deque((query, asyncio.ensure_future(self.search(query, types, limit, 0, market))) for query in islice(queries, window))
+        try:
+            while pending:
+                query, task = pending.popleft()
+                pending.extend((next_query, asyncio.ensure_future(self.search(next_query, types, limit, 0, market))) for next_query in islice(queries, 1))
+                yield query, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def _request(self, request_type, url:str, scope=None, params=None, data=None):
+        params = self._parse_params(params) if params else None
+        data = json.dumps(data) if data else None
+        key = self._coalesce_key(request_type, url, scope, params)
+        if key is None:
+            return await self._cached_request(request_type, url, scope, params, data)
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self.inflight[key] = asyncio.ensure_future(self._cached_request(request_type, url, scope, params, data))
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task) #a cancelled caller does not cancel the request the others wait on
+
+    async def _cached_request(self, request_type, url:str, scope=None, params=None, data=None):
+        key, cached = self._cache_lookup(request_type, url, scope, params)
+        if key is None:
+            return await self._send(request_type, url, scope, params, data)
+        if cached is not None and cached[2]:
+            return self._response(200, {"Content-Type":"application/json", "ETag":cached[0]}, cached[1], self.base_url + url)
+        response = await self._send(request_type, url, scope, params, data, {"If-None-Match":cached[0]} if cached is not None and cached[0] else None)
+        return self._cache_store(key, cached, response)
+
+    async def _send(self, request_type, url:str, scope=None, params=None, data=None, headers:dict=None):
+        attempt = 0
+        while True:
+            await self.scheduler.wait_async()
+            if self.instrumentation is not None:
+                start = perf_counter()
+            if self.transport.offline:
+                authorization, requested = "Bearer offline", False
+            else:
+                token, requested = await self._get_token(scope)
+                authorization = f'{token["token_type"]} {token["access_token"]}'
+            if self.instrumentation is not None:
+                self.instrumentation.record_token(perf_counter() - start, requested)
+                endpoint, start = self.instrumentation.before(request_type, url, params), perf_counter()
+            try:
+                response = await self.transport.send_async(request_type, self.base_url + url, params, data, dict(headers or {}, Authorization=authorization))
+            except Exception:
+                if self.instrumentation is not None:
+                    self.instrumentation.record_request(request_type, endpoint, 0, perf_counter() - start, 0)
+                raise
+            if self.instrumentation is not None:
+                self.instrumentation.record_request(request_type, endpoint, response.status_code, perf_counter() - start, len(response.content))
+            delay = self.scheduler.retry_delay(request_type, response, attempt)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def sync_playlist(self, playlist_id:str, desired_ids:list):
+        snapshot_id = self._playlist_snapshot(await self.get_playlist(playlist_id, fields=["snapshot_id"]))
+        current = [item["track"]["uri"] async for item in self.iter_playlist_tracks(playlist_id, fields=["total", "items(track(uri))"]) if item.get("track")]
+        steps = self._playlist_diff(current, self._id_to_uri(desired_ids, "track"))
+        for step in steps:
+            snapshot_id = self._playlist_snapshot(await self._playlist_step(playlist_id, step, snapshot_id))
+        return self._sync_report(steps, len(current), snapshot_id)
+
+    async def _get_entities(self, url:str, ids:list, key:str, type_of:str, scope=None, params:dict=None):
+        found, missing = self._entity_lookup(type_of, ids, params)
+        if found is not None and not missing:
+            return self._response(200, {"Content-Type":"application/json"}, json.dumps({key:[found[entity_id] for entity_id in ids]}).encode(), self.base_url + url)
+        response = await self._request("GET", url, scope, params=dict(params or {}, ids=missing))
+        if found is None or response.status_code != 200:
+            return response
+        merged = self._entity_merge(type_of, ids, found, missing, response.json()[key])
+        return self._response(200, response.headers, json.dumps({key:merged}).encode(), response.url)
+
+    async def _fan_out(self, url:str, ids:list, chunk_size:int, key:str, scope=None, params:dict=None, type_of:str=None):
+        found, missing = self._entity_lookup(type_of, ids, params)
+        chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        async def fetch(chunk):
+            response = await self._request("GET", url, scope, params=dict(params or {}, ids=chunk))
+            if response.status_code != 200:
+                raise Exception(f"{url} failed with status {response.status_code}: {response.text}")
+            return response.json()[key]
+        fetched = [item for items in await asyncio.gather(*map(fetch, chunks)) for item in items]
+        return fetched if found is None else self._entity_merge(type_of, ids, found, missing, fetched)
 
+    async def _iter_offset(self, fetch, key:str=None, limit:int=50, offset:int=0, read_ahead:int=4, end:int=None):
+        async def page(page_offset):
+            response = await fetch(limit, page_offset)
+            if response.status_code != 200:
+                raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+            body = response.json()
+            return body[key] if key else body
+        first = await page(offset)
+        for item in first["items"]:
+            yield item
+        offsets = iter(range(offset + limit, min(first["total"], end) if end else first["total"], limit))
+        window = deque(asyncio.ensure_future(page(page_offset)) for page_offset in islice(offsets, max(read_ahead, 1)))
+        try:
+            while window:
+                items = (await window.popleft())["items"]
+                window.extend(asyncio.ensure_future(page(page_offset)) for page_offset in islice(offsets, 1))
+                for item in items:
+                    yield item
+        finally:
+            for task in window:
+                task.cancel()
+
+    async def _iter_cursor(self, fetch, key:str, limit:int=50):
+        after = None
+        while True:
+            response = await fetch(limit, after)
+            if response.status_code != 200:
+                raise Exception(f"{response.url} failed with status {response.status_code}: {response.text}")
+            body = response.json()[key]
+            for item in body["items"]:
+                yield item
+            after = (body.get("cursors") or {}).get("after")
+            if not after or not body.get("next"):
+                return
+
+class ClientPool(object):
+    """
+    Api clients for many users of one application, sharing one connection pool (Session), one client credentials token, and the scheduler and caches given.
+    The tokens of every user live in store, a user's Api is built when asked for and dropped once nothing holds it, so memory and sockets grow with the active users only.
+    
+        pool = ClientPool("credentials.json", SQLiteTokenStore("tokens.db"))
+        pool.add_user("alice", tokens) #tokens from the application's own authorization flow
+        pool["alice"].get_user_top("artists")
+    
+    Parameters:
+    
+        - credentials: Path of the application credentials file, or its content as a dict ("user" is not needed).
+        - store: Token store shared by the users. Default: a MemoryTokenStore.
+        - max_connections: Size of the shared connection pool.
+        - auth_mode: auth_mode of the users' Auth, used when a user has no (valid) token in the store. Default: none, such a request raises,
+          as a server thread must not wait on an interactive authorization; pass loopback, headless or browser to allow one.
+        - The rest are passed to every Api.
+    """
+    def __init__(self, credentials, store=None, max_connections:int=100, auth_mode:str="none", max_workers:int=8, scheduler:RequestScheduler=None, cache:ResponseCache=None,
+                 entity_cache:EntityCache=None, instrumentation:Instrumentation=None, search_cache:ResponseCache=None):
+        if not isinstance(credentials, dict):
+            with open(credentials) as credentials_file:
+                credentials = json.load(credentials_file)
+        self.credentials = dict(credentials, user=credentials.get("user")) #the users are set per Auth
+        self.store = store if store is not None else MemoryTokenStore()
+        self.auth_mode = auth_mode
+        self.max_workers = max_workers
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        self.cache = cache
+        self.entity_cache = entity_cache
+        self.instrumentation = instrumentation
+        self.search_cache = search_cache
+        self.session = Api.new_session(max_connections)
+        self.client_auth = Auth(self.credentials, store=UserTokens(MemoryTokenStore(), None), session=self.session)
+        self.lock = Lock()
+        self.clients = WeakValueDictionary()
+        self.created = 0
+
+    def add_user(self, user:str, tokens:dict):
+        """
+        Save a user's token response (with its refresh_token) to the store, expires_at is added if missing.
+        """
+        tokens = dict(tokens)
+        tokens.setdefault("expires_at", time() + tokens.get("expires_in", 0))
+        self.store.save(user, tokens)
+        with self.lock:
+            client = self.clients.get(user)
+        if client is not None:
+            client.auth.store.tokens = tokens
+
+    def get(self, user:str):
+        """
+        The Api of user, the same object for as long as it is referenced.
+        """
+        with self.lock:
+            client = self.clients.get(user)
+            if client is None:
+                auth = Auth(dict(self.credentials, user=user), auth_mode=self.auth_mode, session=self.session, store=UserTokens(self.store, user), client_auth=self.client_auth)
+                client = Api(None, max_workers=self.max_workers, scheduler=self.scheduler, cache=self.cache, entity_cache=self.entity_cache, instrumentation=self.instrumentation,
+                             session=self.session, auth=auth, search_cache=self.search_cache)
+                self.clients[user] = client
+                self.created += 1
+            return client
+
+    __getitem__ = get
+
+    def __len__(self):
+        return len(self.clients)
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        """
+        Users with an Api alive right now, Apis built so far, and the token requests of the users alive plus the shared client token.
+        """
+        with self.lock:
+            clients = list(self.clients.values())
+        return {"active":len(clients), "created":self.created, "refreshes":sum(client.auth.refreshes for client in clients),
+                "authorizations":sum(client.auth.authorizations for client in clients), "client_tokens":self.client_auth.client_tokens}